@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+'''
+Measure the start-up time of each command-line tool (and of the shared
+modules they import) and check that it stays under a target. Each entry
+point is run in a fresh interpreter several times and the fastest run is
+reported, so that the result reflects import cost rather than system noise.
+Exits with status 1 if any entry point is over its target.
+'''
+
+import argparse, os, subprocess, sys, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# (label, interpreter arguments)
+entry_points = [
+    ('gen_orbitals.py', [os.path.join(here, 'gen_orbitals.py'), '--help']),
+    ('jmol_orbital_browser.py', [os.path.join(here, 'jmol_orbital_browser.py'), '--help']),
+    ('nudge_structure.py', [os.path.join(here, 'nudge_structure.py'), '--help']),
+    ('webmo_to_canonical_xyz.py', [os.path.join(here, 'webmo_to_canonical_xyz.py'), '--help']),
+    ('xyz_rmsd.py', [os.path.join(here, 'xyz_rmsd.py'), '--help']),
+    ('import elements', ['-c', 'import elements']),
+    ('import xyz_io', ['-c', 'import xyz_io']),
+]
+
+def time_entry_point(args, repeat):
+    best = None
+    for irun in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=here, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+parser = argparse.ArgumentParser(description='Check start-up time of the command-line tools.')
+parser.add_argument('-t', '--target', type=float, default=0.25,
+                    help='Maximum acceptable start-up time in seconds (default: %(default)s)')
+parser.add_argument('-n', '--repeat', type=int, default=5,
+                    help='Number of runs of each entry point (default: %(default)s)')
+args = parser.parse_args()
+
+baseline = time_entry_point(['-c', 'pass'], args.repeat)
+print('Bare interpreter: {:8.3f} s'.format(baseline))
+
+failed = False
+for label, entry_args in entry_points:
+    elapsed = time_entry_point(entry_args, args.repeat)
+    over = elapsed > args.target
+    failed = failed or over
+    print('{:30s} {:8.3f} s {}'.format(label, elapsed, 'OVER TARGET' if over else 'ok'))
+
+sys.exit(1 if failed else 0)
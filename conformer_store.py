@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+'''
+Persistent store of conformers of one molecule, with fast duplicate lookup.
+
+A store is a directory holding:
+
+    meta.json         atoms, number of conformers and file sizes
+    coords.f64        coordinates, a (conformers, atoms, 3) float64 array
+    fingerprints.f64  rotation-invariant fingerprints, (conformers, K) float64
+    metadata.jsonl    one JSON object (source file, frame, title) per conformer
+    metadata.i64      byte offset of each conformer's line in metadata.jsonl
+
+The arrays are memory-mapped, and conformers are appended in place, so
+adding one conformer, or looking up its metadata, costs the same however
+large the store is. Several
+processes may add to the same store; additions are serialized with a
+lock file, and each addition first picks up conformers added by others.
+
+Finding conformers within an RMSD threshold of a structure does not
+compare it with every stored conformer. Each conformer's fingerprint is
+built from the distances of its atoms to the centroid, summed over K
+groups of atoms and scaled so that the Euclidean distance between two
+fingerprints is at most sqrt(atoms) times the RMSD between the aligned
+structures. A KD-tree over the fingerprints (from scipy, if installed)
+therefore shortlists every conformer that can be within the threshold.
+The shortlist is narrowed with the same bound on the full set of
+distances, and only the survivors are aligned with QCP to get exact
+RMSDs. Conformers added since the tree was built are scanned directly,
+and the tree is rebuilt once they become a sizeable fraction of the store.
+
+    conformer_store.py STORE add -t 0.1 search/*.xyz
+    conformer_store.py STORE query new.xyz
+'''
+
+import argparse, contextlib, fcntl, json, os, sys
+
+import numpy as np
+
+from xyz_io import XYZFile
+from xyz_rmsd import calc_rmsd
+
+STORE_VERSION = 1
+MAX_FINGERPRINT_SIZE = 12
+DEFAULT_THRESHOLD = 0.1
+
+class ConformerStoreError(ValueError):
+    pass
+
+def centroid_distances(coords):
+    '''Distances of atoms to the centroid, for one (atoms, 3) or many
+    (conformers, atoms, 3) structures, as a (conformers, atoms) array. For
+    two structures, the Euclidean distance between these is at most
+    sqrt(atoms) times their RMSD.'''
+    coords = np.asarray(coords, np.float64)
+    if coords.ndim == 2:
+        coords = coords[None]
+    centered = coords - coords.mean(axis=1, keepdims=True)
+    return np.sqrt((centered**2).sum(axis=2))
+
+def conformer_fingerprints(coords, n_components):
+    '''Fingerprints of one (atoms, 3) or many (conformers, atoms, 3)
+    structures, as a (conformers, n_components) array. Atoms are split into
+    n_components groups; each component is the sum of the distances of a
+    group's atoms to the centroid, divided by the square root of the group
+    size.'''
+    radii = centroid_distances(coords)
+    groups = np.array_split(np.arange(radii.shape[1]), n_components)
+    return np.stack([radii[:, group].sum(axis=1) / len(group)**0.5 for group in groups], axis=1)
+
+class ConformerStore:
+    # Rebuild the KD-tree when this many conformers, or this fraction of
+    # the store, have been added since it was built
+    min_unindexed = 1024
+    max_unindexed_fraction = 0.125
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = None
+        self.coords = None
+        self.fingerprints = None
+        self.metadata_offsets = None
+        self._tree = None
+        self._n_indexed = 0
+        self.refresh()
+
+    def __len__(self):
+        return self.meta['count'] if self.meta else 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def symbols(self):
+        return self.meta['symbols'] if self.meta else None
+
+    def refresh(self):
+        '''Pick up conformers added since the store was opened, possibly by
+        another process'''
+        try:
+            with open(self._path('meta.json'), 'rt') as metafile:
+                meta = json.load(metafile)
+        except FileNotFoundError:
+            return
+        if meta.get('version') != STORE_VERSION:
+            raise ConformerStoreError('{} is not a version {:d} conformer store'
+                                      .format(self.directory, STORE_VERSION))
+        if meta == self.meta:
+            return
+
+        (count, natoms, n_components) = (meta['count'], len(meta['symbols']), meta['fingerprint_size'])
+        if count:
+            self.coords = np.memmap(self._path('coords.f64'), np.float64, 'r',
+                                    shape=(count, natoms, 3))
+            self.fingerprints = np.memmap(self._path('fingerprints.f64'), np.float64, 'r',
+                                          shape=(count, n_components))
+            self.metadata_offsets = np.memmap(self._path('metadata.i64'), np.int64, 'r',
+                                              shape=(count,))
+        else:
+            self.coords = np.empty((0, natoms, 3))
+            self.fingerprints = np.empty((0, n_components))
+            self.metadata_offsets = np.empty((0,), np.int64)
+        self.meta = meta
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self._path('lock'), 'ab') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _write_meta(self, meta):
+        tmpfilename = self._path('meta.json.tmp')
+        with open(tmpfilename, 'wt') as metafile:
+            json.dump(meta, metafile)
+        os.replace(tmpfilename, self._path('meta.json'))
+
+    def _append(self, name, data, expected_size):
+        # Discard anything written after the last complete addition (e.g.
+        # by an interrupted process) before appending
+        with open(self._path(name), 'ab') as outfile:
+            outfile.truncate(expected_size)
+            outfile.write(data)
+
+    def metadata(self, index):
+        '''Metadata (a dict) of the conformer with the given index'''
+        index = range(len(self))[index]
+        start = int(self.metadata_offsets[index])
+        end = (int(self.metadata_offsets[index + 1]) if index + 1 < len(self)
+               else self.meta['metadata_bytes'])
+        with open(self._path('metadata.jsonl'), 'rb') as metadatafile:
+            metadatafile.seek(start)
+            return json.loads(metadatafile.read(end - start).decode('utf8'))
+
+    def _update_index(self):
+        n_unindexed = len(self) - self._n_indexed
+        if n_unindexed <= max(self.min_unindexed, self.max_unindexed_fraction * self._n_indexed):
+            return
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            # Without scipy, every fingerprint is scanned; still vectorized
+            return
+        self._tree = cKDTree(np.asarray(self.fingerprints))
+        self._n_indexed = len(self)
+
+    def shortlist(self, fingerprint, radius):
+        '''Indices of conformers whose fingerprints are within radius of
+        fingerprint, nearest first'''
+        self._update_index()
+        indices = []
+        if self._tree is not None:
+            indices.extend(self._tree.query_ball_point(fingerprint, radius))
+        distances = np.sqrt(((self.fingerprints[self._n_indexed:] - fingerprint)**2).sum(axis=1))
+        indices.extend(self._n_indexed + np.flatnonzero(distances <= radius))
+
+        indices = np.array(indices, np.intp)
+        distances = np.sqrt(((self.fingerprints[indices] - fingerprint)**2).sum(axis=1))
+        return indices[np.argsort(distances, kind='stable')]
+
+    def find(self, coords, threshold=DEFAULT_THRESHOLD, first=False):
+        '''Return (index, RMSD) of the stored conformers within threshold
+        (Angstroms) RMSD of coords after alignment, closest first. If first
+        is true, stop at the first one found.'''
+        if not len(self):
+            return []
+        coords = np.ascontiguousarray(coords, np.float64)
+        if coords.shape != self.coords.shape[1:]:
+            raise ConformerStoreError('structure has {:d} atoms; store has {:d}'
+                                      .format(len(coords), self.coords.shape[1]))
+        fingerprint = conformer_fingerprints(coords, self.meta['fingerprint_size'])[0]
+        radius = len(coords)**0.5 * threshold
+        candidates = self.shortlist(fingerprint, radius)
+
+        # The per-atom distances the fingerprint is built from bound the
+        # RMSD more tightly, and are cheap compared with alignment
+        radii_distances = np.sqrt(((centroid_distances(self.coords[candidates])
+                                    - centroid_distances(coords))**2).sum(axis=1))
+        candidates = candidates[radii_distances <= radius]
+
+        matches = []
+        for index in candidates:
+            rmsd = calc_rmsd(np.array(self.coords[index]), coords)
+            if rmsd <= threshold:
+                matches.append((int(index), rmsd))
+                if first:
+                    break
+        return sorted(matches, key=lambda match: match[1])
+
+    def add(self, coords, symbols, metadata=None, threshold=None):
+        '''Add a conformer unless threshold is given and a stored conformer
+        is within threshold RMSD of it. Returns (index, None) for a new
+        conformer, or (index, RMSD) of the existing duplicate.'''
+        coords = np.ascontiguousarray(coords, np.float64)
+        symbols = list(symbols)
+        with self._locked():
+            self.refresh()
+            if self.meta is None:
+                meta = {'version': STORE_VERSION,
+                        'symbols': symbols,
+                        'fingerprint_size': min(MAX_FINGERPRINT_SIZE, len(symbols)),
+                        'count': 0,
+                        'metadata_bytes': 0}
+            else:
+                meta = dict(self.meta)
+                if symbols != meta['symbols']:
+                    raise ConformerStoreError('atoms do not match those of the conformers in {}'
+                                              .format(self.directory))
+                if threshold is not None:
+                    matches = self.find(coords, threshold, first=True)
+                    if matches:
+                        return matches[0]
+
+            count = meta['count']
+            fingerprint = conformer_fingerprints(coords, meta['fingerprint_size'])
+            metadata_line = (json.dumps(metadata or {}) + '\n').encode('utf8')
+            self._append('coords.f64', coords.tobytes(), count * coords.nbytes)
+            self._append('fingerprints.f64', fingerprint.tobytes(), count * fingerprint.nbytes)
+            self._append('metadata.jsonl', metadata_line, meta['metadata_bytes'])
+            offset = np.array([meta['metadata_bytes']], np.int64)
+            self._append('metadata.i64', offset.tobytes(), count * offset.nbytes)
+
+            meta['count'] = count + 1
+            meta['metadata_bytes'] += len(metadata_line)
+            self._write_meta(meta)
+            self.refresh()
+        return count, None
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Store conformers and find duplicates by RMSD.')
+    parser.add_argument('store', help='Conformer store directory (created if necessary)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add', help='Add every frame of XYZ files to the store, '
+                                                   'skipping duplicates')
+    add_parser.add_argument('xyzfiles', nargs='+')
+    add_parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                            help='RMSD (Angstroms) below which a structure is a duplicate '
+                                +'(default: %(default)s)')
+    add_parser.add_argument('-k', '--keep-duplicates', action='store_true',
+                            help='Add structures even if they duplicate stored conformers')
+
+    query_parser = subparsers.add_parser('query', help='Find stored conformers matching every '
+                                                       'frame of XYZ files')
+    query_parser.add_argument('xyzfiles', nargs='+')
+    query_parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                              help='RMSD (Angstroms) within which to report conformers '
+                                  +'(default: %(default)s)')
+
+    subparsers.add_parser('info', help='Summarize the store')
+    return parser
+
+def run(args, stdout=None, stderr=None):
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    try:
+        store = ConformerStore(args.store)
+        if args.command == 'info':
+            print('{}: {:d} conformers of {:d} atoms'
+                  .format(args.store, len(store), len(store.symbols or [])), file=stdout)
+            return 0
+
+        for filename in args.xyzfiles:
+            with XYZFile(filename) as xyzfile:
+                for iframe, frame in enumerate(xyzfile):
+                    source = '{}:{:d}'.format(filename, iframe)
+                    if args.command == 'add':
+                        threshold = None if args.keep_duplicates else args.threshold
+                        (index, rmsd) = store.add(frame.coords, frame.symbols,
+                                                  {'source': source, 'title': frame.title.strip()},
+                                                  threshold)
+                        if rmsd is None:
+                            print('{} added as {:d}'.format(source, index), file=stdout)
+                        else:
+                            print('{} duplicates {:d} ({}), RMSD {:.4f}'
+                                  .format(source, index, store.metadata(index)['source'], rmsd),
+                                  file=stdout)
+                    else:
+                        matches = store.find(frame.coords, args.threshold)
+                        print('{}: {:d} matches'.format(source, len(matches)), file=stdout)
+                        for (index, rmsd) in matches:
+                            print('    {:d} ({}), RMSD {:.4f}'
+                                  .format(index, store.metadata(index)['source'], rmsd), file=stdout)
+    except (OSError, ValueError) as e:
+        print(e, file=stderr)
+        return 1
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+'''
+Reading and writing of Gaussian cube files, and of a compact binary
+equivalent.
+
+Compact cube files store the cube header verbatim together with the grid as
+float32, split into chunks of whole x-planes that are compressed separately
+(zlib, or LZ4 if the lz4 package is installed). An index of the chunks is
+kept in a footer, so a chunk of planes can be read without decompressing
+the rest. Grids can be block-averaged to a coarser preview grid on the way
+in. Both formats are processed a slab of x-planes at a time, so memory use
+does not grow with the size of the grid.
+
+    cube_io.py compact mo10a.cube                 # writes mo10a.cubez
+    cube_io.py compact mo10a.cube -d 3 -o p.cubez # 3x3x3 block-averaged preview
+    cube_io.py expand mo10a.cubez                 # writes mo10a.cube
+'''
+
+import argparse, itertools, json, math, os, struct, zlib
+
+import numpy as np
+
+COMPACT_MAGIC = b'CUBEZ\x00\x01\n'
+_footer = struct.Struct('<Q8s')
+
+# Values per line in the data section of cube files
+CUBE_VALUES_PER_LINE = 6
+
+class CubeHeader:
+    '''Header of a cube file: two comment lines, the grid origin and axes,
+    and the atoms. A header read from a file keeps its text, which format()
+    reproduces verbatim; derived headers (e.g. downsampled()) are formatted
+    from the parsed values, keeping atom lines (and the orbital ID line of
+    MO cubes) verbatim.'''
+
+    def __init__(self, comments, natoms, origin, shape, axes, atom_lines, dset_line=None,
+                 nval=None, text=None):
+        self.comments = list(comments)
+        self.natoms = natoms
+        self.origin = np.asarray(origin, np.float64)
+        self.shape = tuple(shape)
+        self.axes = np.asarray(axes, np.float64)
+        self.atom_lines = list(atom_lines)
+        self.dset_line = dset_line
+        # Optional NVal column of the origin line
+        self.nval = nval
+        self.text = text
+
+    @classmethod
+    def read(cls, infile):
+        lines = []
+        def next_line():
+            line = next(infile)
+            lines.append(line)
+            return line
+
+        comments = [next_line().rstrip('\n'), next_line().rstrip('\n')]
+
+        fields = next_line().split()
+        natoms = int(fields[0])
+        origin = [float(field) for field in fields[1:4]]
+        nval = int(fields[4]) if len(fields) > 4 else None
+        if nval not in (None, 1):
+            raise NotImplementedError('only one value per grid point is supported')
+
+        shape = []
+        axes = []
+        for iaxis in range(3):
+            fields = next_line().split()
+            shape.append(int(fields[0]))
+            axes.append([float(field) for field in fields[1:4]])
+
+        atom_lines = [next_line().rstrip('\n') for iatom in range(abs(natoms))]
+
+        dset_line = None
+        if natoms < 0:
+            # MO cubes list the orbitals they contain after the atoms
+            dset_line = next_line().rstrip('\n')
+            if int(dset_line.split()[0]) != 1:
+                raise NotImplementedError('only one orbital per cube file is supported')
+
+        text = ''.join(lines)
+        if not text.endswith('\n'):
+            text += '\n'
+        return cls(comments, natoms, origin, shape, axes, atom_lines, dset_line, nval, text)
+
+    @classmethod
+    def from_text(cls, text):
+        return cls.read(iter(text.splitlines(True)))
+
+    def format(self):
+        if self.text is not None:
+            return self.text
+        lines = list(self.comments)
+        lines.append('{:5d}{:12.6f}{:12.6f}{:12.6f}'.format(self.natoms, *self.origin)
+                     + ('' if self.nval is None else '{:5d}'.format(self.nval)))
+        for npoints, axis in zip(self.shape, self.axes):
+            lines.append('{:5d}{:12.6f}{:12.6f}{:12.6f}'.format(npoints, *axis))
+        lines.extend(self.atom_lines)
+        if self.dset_line is not None:
+            lines.append(self.dset_line)
+        return '\n'.join(lines) + '\n'
+
+    @property
+    def plane_size(self):
+        return self.shape[1] * self.shape[2]
+
+    def downsampled(self, factor):
+        '''Header for the grid obtained by averaging factor**3 blocks of points.
+        Points are placed at the centers of (full) blocks.'''
+        shape = tuple(math.ceil(npoints / factor) for npoints in self.shape)
+        origin = self.origin + (factor - 1) / 2 * self.axes.sum(axis=0)
+        comments = list(self.comments)
+        comments[1] = (comments[1] + ' (downsampled x{:d})'.format(factor)).strip()
+        return CubeHeader(comments, self.natoms, origin, shape, self.axes * factor,
+                          self.atom_lines, self.dset_line, self.nval)
+
+def _read_values(infile, count, leftover):
+    '''Read count whitespace-separated values from infile, regardless of how
+    they are split over lines. Returns (values, leftover values).'''
+    parts = [leftover]
+    have = len(leftover)
+    while have < count:
+        nlines = max(1, math.ceil((count - have) / CUBE_VALUES_PER_LINE))
+        text = ''.join(itertools.islice(infile, nlines))
+        if not text:
+            raise ValueError('unexpected end of cube file')
+        values = np.fromstring(text, dtype=np.float64, sep=' ')
+        parts.append(values)
+        have += len(values)
+    values = np.concatenate(parts)
+    return values[:count], values[count:]
+
+class CubeFile:
+    '''Read access to an ASCII cube file, a slab of x-planes at a time'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rt')
+        self.header = CubeHeader.read(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def iter_slabs(self, planes_per_slab):
+        '''Yield (nplanes, ny, nz) arrays of consecutive x-planes. Can only be
+        iterated once.'''
+        (nx, ny, nz) = self.header.shape
+        leftover = np.empty((0,), np.float64)
+        for ix in range(0, nx, planes_per_slab):
+            nplanes = min(planes_per_slab, nx - ix)
+            values, leftover = _read_values(self._file, nplanes * ny * nz, leftover)
+            yield values.reshape(nplanes, ny, nz)
+
+    def read(self):
+        return np.concatenate(list(self.iter_slabs(self.header.shape[0])))
+
+class CompactCubeFile:
+    '''Read access to a compact cube file, by chunk of x-planes'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+
+        if self._file.read(len(COMPACT_MAGIC)) != COMPACT_MAGIC:
+            raise ValueError('{} is not a compact cube file'.format(filename))
+        self._file.seek(-_footer.size, os.SEEK_END)
+        (meta_offset, magic) = _footer.unpack(self._file.read(_footer.size))
+        if magic != COMPACT_MAGIC:
+            raise ValueError('{} is truncated'.format(filename))
+        self._file.seek(meta_offset)
+        meta_size = os.fstat(self._file.fileno()).st_size - _footer.size - meta_offset
+        self.meta = json.loads(self._file.read(meta_size).decode('UTF8'))
+
+        self.header = CubeHeader.from_text(self.meta['header'])
+        self.chunk_planes = self.meta['chunk_planes']
+        self.chunks = self.meta['chunks']
+        self._decompress = _codecs[self.meta['codec']][1]()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def read_chunk(self, ichunk):
+        (offset, nbytes) = self.chunks[ichunk]
+        self._file.seek(offset)
+        raw = self._decompress(self._file.read(nbytes))
+        data = np.frombuffer(raw, np.uint8)
+        if self.meta['shuffle']:
+            data = data.reshape(4, -1).T.copy()
+        data = data.view(np.float32)
+        (nx, ny, nz) = self.header.shape
+        return data.reshape(-1, ny, nz)
+
+    def iter_slabs(self, planes_per_slab=None):
+        '''Yield (nplanes, ny, nz) float32 arrays of consecutive x-planes.
+        Slabs are whole chunks unless planes_per_slab is given.'''
+        chunks = (self.read_chunk(ichunk) for ichunk in range(len(self.chunks)))
+        if planes_per_slab is None:
+            yield from chunks
+        else:
+            yield from _reslab(chunks, planes_per_slab)
+
+    def read_planes(self, start, stop):
+        '''Read x-planes start to stop (exclusive), decompressing only the
+        chunks that contain them'''
+        first = start // self.chunk_planes
+        last = (stop - 1) // self.chunk_planes
+        data = np.concatenate([self.read_chunk(ichunk) for ichunk in range(first, last + 1)])
+        return data[start - first*self.chunk_planes:stop - first*self.chunk_planes]
+
+    def read(self):
+        return np.concatenate(list(self.iter_slabs()))
+
+def _reslab(slabs, planes_per_slab):
+    '''Regroup a stream of slabs of x-planes into slabs of planes_per_slab planes'''
+    pending = []
+    npending = 0
+    for slab in slabs:
+        pending.append(slab)
+        npending += len(slab)
+        while npending >= planes_per_slab:
+            data = np.concatenate(pending)
+            yield data[:planes_per_slab]
+            pending = [data[planes_per_slab:]]
+            npending -= planes_per_slab
+    if npending:
+        yield np.concatenate(pending)
+
+def _zlib_compressor(level):
+    return lambda data: zlib.compress(data, level)
+
+def _zlib_decompressor():
+    return zlib.decompress
+
+def _lz4_compressor(level):
+    import lz4.frame
+    return lambda data: lz4.frame.compress(data, compression_level=level)
+
+def _lz4_decompressor():
+    import lz4.frame
+    return lz4.frame.decompress
+
+# codec -> (compressor factory, decompressor factory)
+_codecs = {
+    'zlib': (_zlib_compressor, _zlib_decompressor),
+    'lz4': (_lz4_compressor, _lz4_decompressor),
+}
+
+def open_cube(filename):
+    '''Open an ASCII or compact cube file, based on its contents'''
+    with open(filename, 'rb') as infile:
+        compact = infile.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC
+    return CompactCubeFile(filename) if compact else CubeFile(filename)
+
+def downsample_slab(slab, factor):
+    '''Average blocks of factor**3 points of a slab of x-planes. Blocks at
+    the ends of the grid axes may be smaller.'''
+    for axis in range(3):
+        starts = np.arange(0, slab.shape[axis], factor)
+        counts = np.diff(np.append(starts, slab.shape[axis]))
+        shape = [1, 1, 1]
+        shape[axis] = len(counts)
+        slab = np.add.reduceat(slab, starts, axis=axis) / counts.reshape(shape)
+    return slab
+
+def downsample_slabs(slabs, factor):
+    return (downsample_slab(slab, factor) for slab in _reslab(slabs, factor))
+
+def write_compact_cube(filename, header, slabs, codec='zlib', level=6, chunk_planes=8,
+                       shuffle=True):
+    '''Write a compact cube file from a stream of slabs of x-planes'''
+    compress = _codecs[codec][0](level)
+    chunks = []
+    with open(filename, 'wb') as outfile:
+        outfile.write(COMPACT_MAGIC)
+        for chunk in _reslab(slabs, chunk_planes):
+            data = np.ascontiguousarray(chunk, dtype=np.float32).view(np.uint8)
+            if shuffle:
+                # Group the bytes of each float by significance, which
+                # compresses much better
+                data = data.reshape(-1, 4).T.copy()
+            compressed = compress(data.tobytes())
+            chunks.append((outfile.tell(), len(compressed)))
+            outfile.write(compressed)
+
+        meta = {'header': header.format(),
+                'dtype': 'float32',
+                'codec': codec,
+                'shuffle': shuffle,
+                'chunk_planes': chunk_planes,
+                'chunks': chunks}
+        meta_offset = outfile.tell()
+        outfile.write(json.dumps(meta).encode('UTF8'))
+        outfile.write(_footer.pack(meta_offset, COMPACT_MAGIC))
+
+def format_cube_values(slab):
+    '''Format a slab of x-planes as cube file data lines'''
+    (nplanes, ny, nz) = slab.shape
+    nfull, nlast = divmod(nz, CUBE_VALUES_PER_LINE)
+    row_format = (' {:12.5E}' * CUBE_VALUES_PER_LINE + '\n') * nfull
+    if nlast:
+        row_format += ' {:12.5E}' * nlast + '\n'
+    plane_format = row_format * ny
+    return ''.join(plane_format.format(*plane.ravel().tolist()) for plane in slab)
+
+def write_cube(filename, header, slabs):
+    '''Write an ASCII cube file from a stream of slabs of x-planes'''
+    with open(filename, 'wt') as outfile:
+        outfile.write(header.format())
+        for slab in slabs:
+            outfile.write(format_cube_values(slab))
+
+def compact_cube(cubefile, compactfile=None, downsample=None, codec='zlib', level=6,
+                 chunk_planes=8):
+    '''Convert an ASCII cube file to a compact cube file, optionally
+    downsampling it. Returns the name of the compact file.'''
+    compactfile = compactfile or os.path.splitext(cubefile)[0] + '.cubez'
+    with CubeFile(cubefile) as cube:
+        header = cube.header
+        slabs = cube.iter_slabs(chunk_planes * (downsample or 1))
+        if downsample and downsample > 1:
+            header = header.downsampled(downsample)
+            slabs = downsample_slabs(slabs, downsample)
+        write_compact_cube(compactfile, header, slabs, codec=codec, level=level,
+                           chunk_planes=chunk_planes)
+    return compactfile
+
+def expand_cube(compactfile, cubefile=None):
+    '''Convert a compact cube file back to an ASCII cube file'''
+    cubefile = cubefile or os.path.splitext(compactfile)[0] + '.cube'
+    with CompactCubeFile(compactfile) as cube:
+        write_cube(cubefile, cube.header, cube.iter_slabs())
+    return cubefile
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Convert cube files to and from a compact '
+                                                 'compressed float32 format.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = subparsers.add_parser('compact', help='Convert cube files to compact form')
+    compact_parser.add_argument('cubefiles', nargs='+')
+    compact_parser.add_argument('-o', '--output',
+                                help='Output file (only with one input; default: CUBEFILE.cubez)')
+    compact_parser.add_argument('-d', '--downsample', type=int,
+                                help='Average blocks of DOWNSAMPLE^3 grid points')
+    compact_parser.add_argument('-c', '--codec', choices=sorted(_codecs), default='zlib',
+                                help='Compression codec (lz4 requires the lz4 package; '
+                                    +'default: %(default)s)')
+    compact_parser.add_argument('-l', '--level', type=int, default=6,
+                                help='Compression level (default: %(default)s)')
+    compact_parser.add_argument('--remove', action='store_true',
+                                help='Remove each cube file after converting it')
+
+    expand_parser = subparsers.add_parser('expand', help='Convert compact cube files to cube files')
+    expand_parser.add_argument('compactfiles', nargs='+')
+    expand_parser.add_argument('-o', '--output',
+                               help='Output file (only with one input; default: COMPACTFILE.cube)')
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    inputs = args.cubefiles if args.command == 'compact' else args.compactfiles
+    if args.output and len(inputs) > 1:
+        parser.error('--output can only be used with a single input file')
+
+    for filename in inputs:
+        if args.command == 'compact':
+            outfile = compact_cube(filename, args.output, downsample=args.downsample,
+                                   codec=args.codec, level=args.level)
+            print('{} ({:d} bytes) -> {} ({:d} bytes)'.format(filename, os.path.getsize(filename),
+                                                             outfile, os.path.getsize(outfile)))
+            if args.remove:
+                os.unlink(filename)
+        else:
+            outfile = expand_cube(filename, args.output)
+            print('{} -> {}'.format(filename, outfile))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+'''
+Evaluate arithmetic expressions over cube files, e.g. orbital densities,
+sums over occupied orbitals, differences between structures, or natural
+transition orbital combinations:
+
+    cube_ops.py 'a**2' -i a=mol.mo10a.cube -o density10.cube
+    cube_ops.py 'a - b' -i a=ts.mo42a.cube -i b=min.mo42a.cube -o diff.cube
+    cube_ops.py '2*(occ**2).sum(axis=0)' -i 'occ=mol.mo[0-9]a.cube' -o rho.cube
+    cube_ops.py '0.92*h**2 + 0.08*g**2' -i h=nto.h.cubez -i g=nto.g.cubez -o nto.cube
+
+Each -i NAME=FILE binds NAME to a grid. If FILE is a glob pattern, NAME is
+bound to all matching grids stacked along a new first axis. Inputs may be
+ASCII or compact (see cube_io.py) cube files, and must share the same grid.
+Expressions may use NumPy (as np) and the functions listed in
+expression_functions.
+
+Grids are processed a slab of x-planes at a time, with slabs evaluated in
+parallel, so memory use depends on the slab size and the number of workers
+rather than on the number and size of the grids. The result is written as
+an ASCII cube file (or a compact one if OUTPUT ends in .cubez), ready to be
+turned into an isosurface by Jmol.
+'''
+
+import argparse, ast, collections, concurrent.futures, glob, os
+
+import numpy as np
+
+from cube_io import (CubeHeader, open_cube, format_cube_values, write_compact_cube)
+
+expression_functions = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'sign': np.sign,
+    'where': np.where,
+    'maximum': np.maximum,
+    'minimum': np.minimum,
+    'sum': np.sum,
+    'square': np.square,
+}
+
+class CubeExpressionError(ValueError):
+    pass
+
+def compile_expression(expression, names):
+    '''Compile expression, checking that it only refers to the given input
+    names, np and expression_functions'''
+    try:
+        tree = ast.parse(expression, '<expression>', 'eval')
+    except SyntaxError as e:
+        raise CubeExpressionError('invalid expression {!r}: {}'.format(expression, e))
+
+    allowed = set(names) | set(expression_functions) | {'np'}
+    unknown = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - allowed
+    if unknown:
+        raise CubeExpressionError('unknown name(s) in expression: {}'.format(', '.join(sorted(unknown))))
+    if any(isinstance(node, ast.Attribute) and node.attr.startswith('_') for node in ast.walk(tree)):
+        raise CubeExpressionError('private attributes may not be used in expressions')
+    return compile(tree, '<expression>', 'eval')
+
+def parse_input_specs(specs):
+    '''Parse NAME=FILE specifications into an ordered mapping of NAME to a
+    file name, or to a list of file names for glob patterns'''
+    inputs = collections.OrderedDict()
+    for spec in specs:
+        name, sep, pattern = spec.partition('=')
+        if not sep or not name.isidentifier():
+            raise CubeExpressionError('input must be given as NAME=FILE, not {!r}'.format(spec))
+        if glob.has_magic(pattern):
+            filenames = sorted(glob.glob(pattern))
+            if not filenames:
+                raise CubeExpressionError('{!r} matches no files'.format(pattern))
+            inputs[name] = filenames
+        else:
+            inputs[name] = pattern
+    return inputs
+
+def _check_grids(headers):
+    (filename, reference) = headers[0]
+    for (other_filename, header) in headers[1:]:
+        if (header.shape != reference.shape
+            or not np.allclose(header.origin, reference.origin, atol=1e-5)
+            or not np.allclose(header.axes, reference.axes, atol=1e-5)):
+            raise CubeExpressionError('grid of {} does not match grid of {}'
+                                      .format(other_filename, filename))
+
+def result_header(header, expression):
+    '''Header for a derived grid: same grid and atoms, but no orbital ID'''
+    return CubeHeader(['Generated by cube_ops.py', expression[:200]], abs(header.natoms),
+                      header.origin, header.shape, header.axes, header.atom_lines)
+
+def evaluate_slabs(expression, inputs, planes_per_slab=8, n_workers=None):
+    '''Evaluate expression over the grids named in inputs (a mapping of
+    name to a file name or list of file names), yielding the header of the
+    result followed by consecutive slabs of x-planes of the result.'''
+    code = compile_expression(expression, inputs)
+
+    cubes = collections.OrderedDict()
+    all_cubes = []
+    try:
+        for name, filenames in inputs.items():
+            if isinstance(filenames, str):
+                cubes[name] = open_cube(filenames)
+                all_cubes.append(cubes[name])
+            else:
+                cubes[name] = [open_cube(filename) for filename in filenames]
+                all_cubes.extend(cubes[name])
+
+        _check_grids([(cube.filename, cube.header) for cube in all_cubes])
+        header = all_cubes[0].header
+        yield result_header(header, expression)
+
+        slab_iters = collections.OrderedDict()
+        for name, value in cubes.items():
+            if isinstance(value, list):
+                slab_iters[name] = [cube.iter_slabs(planes_per_slab) for cube in value]
+            else:
+                slab_iters[name] = value.iter_slabs(planes_per_slab)
+
+        def read_next_slab():
+            namespace = {}
+            for name, slabs in slab_iters.items():
+                if isinstance(slabs, list):
+                    namespace[name] = np.stack([next(stack_slabs) for stack_slabs in slabs])
+                else:
+                    namespace[name] = next(slabs)
+            return namespace
+
+        def evaluate(namespace, slab_shape):
+            namespace.update(expression_functions)
+            namespace['np'] = np
+            # compile_expression has already restricted the names used
+            result = np.asarray(eval(code, {}, namespace), np.float64)
+            try:
+                return np.broadcast_to(result, slab_shape)
+            except ValueError:
+                raise CubeExpressionError('expression gives an array of shape {} for a slab of '
+                                          'shape {}; stacked inputs must be reduced (e.g. with '
+                                          '.sum(axis=0))'.format(result.shape, slab_shape))
+
+        (nx, ny, nz) = header.shape
+        n_workers = n_workers or os.cpu_count() or 1
+        in_flight = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            # Reading is sequential; evaluation of up to n_workers slabs
+            # overlaps with reading the next one
+            for ix in range(0, nx, planes_per_slab):
+                slab_shape = (min(planes_per_slab, nx - ix), ny, nz)
+                in_flight.append(pool.submit(evaluate, read_next_slab(), slab_shape))
+                if len(in_flight) > n_workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+    finally:
+        for cube in all_cubes:
+            cube.close()
+
+def evaluate_to_file(expression, inputs, output, planes_per_slab=8, n_workers=None):
+    results = evaluate_slabs(expression, inputs, planes_per_slab, n_workers)
+    header = next(results)
+    if output.endswith('.cubez'):
+        write_compact_cube(output, header, results)
+    else:
+        with open(output, 'wt') as outfile:
+            outfile.write(header.format())
+            for slab in results:
+                outfile.write(format_cube_values(slab))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Evaluate an expression over cube files, '
+                                                 'producing a new cube file.')
+    parser.add_argument('expression', help='Expression to evaluate, e.g. "a**2 - b**2"')
+    parser.add_argument('-i', '--input', action='append', required=True, metavar='NAME=FILE',
+                        help='Bind NAME to the grid in FILE (ASCII or compact cube). If FILE is '
+                            +'a glob pattern, NAME is bound to all matching grids, stacked '
+                            +'along a new first axis. May be given multiple times.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Output cube file (compact if it ends in .cubez)')
+    parser.add_argument('-p', '--slab-planes', type=int, default=8,
+                        help='Number of x-planes per slab; memory use is proportional to this '
+                            +'(default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of slabs to evaluate in parallel (default: %(default)s)')
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        inputs = parse_input_specs(args.input)
+        evaluate_to_file(args.expression, inputs, args.output, args.slab_planes, args.jobs)
+    except CubeExpressionError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
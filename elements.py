@@ -4,7 +4,7 @@ Created on Oct 31, 2021
 @author: mzwier
 '''
 
-import pandas as pd
+import numpy as np
 
 _elements_table = [
     (1,'H','Hydrogen',1.008,1),
@@ -127,21 +127,44 @@ _elements_table = [
     (118,'Og','Oganesson',294.0,294),
 ]
 
-elements = pd.DataFrame.from_records(_elements_table, 
-                                     index='number', 
-                                     columns=['number', 'symbol', 'name', 'mass', 'prevalent_isotope' ])
+_element_columns = ['number', 'symbol', 'name', 'mass', 'prevalent_isotope']
 
-elements_by_number = elements
-elements_by_symbol = elements.reset_index().set_index('symbol')
-elements_by_name   = elements.reset_index().set_index('name')
+# Plain dictionaries for scalar lookups
+_number_by_symbol = {symbol.title(): number for (number, symbol, name, mass, isotope) in _elements_table}
+_number_by_name   = {name.title(): number for (number, symbol, name, mass, isotope) in _elements_table}
+_symbol_by_number = {number: symbol for (number, symbol, name, mass, isotope) in _elements_table}
+
+# Arrays indexed by atomic number for vectorized lookups; entry 0 is a placeholder
+element_symbols = np.array([''] + [row[1] for row in _elements_table], dtype=object)
+element_names   = np.array([''] + [row[2] for row in _elements_table], dtype=object)
+element_masses  = np.array([np.nan] + [row[3] for row in _elements_table], dtype=np.float64)
+
+_dataframes = {}
+
+def __getattr__(attr):
+    # The pandas tables are built only when first used, since importing
+    # pandas dominates the start-up time of scripts that use this module
+    if attr not in ('elements', 'elements_by_number', 'elements_by_symbol', 'elements_by_name'):
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, attr))
+    
+    if not _dataframes:
+        import pandas as pd
+        elements = pd.DataFrame.from_records(_elements_table, 
+                                             index='number', 
+                                             columns=_element_columns)
+        _dataframes['elements'] = elements
+        _dataframes['elements_by_number'] = elements
+        _dataframes['elements_by_symbol'] = elements.reset_index().set_index('symbol')
+        _dataframes['elements_by_name']   = elements.reset_index().set_index('name')
+    return _dataframes[attr]
 
 def element_symbol_to_number(sym):
     sym = sym.title()
-    return elements_by_symbol['number'][sym]
+    return _number_by_symbol[sym]
 
 def element_number_to_symbol(num):
     num = int(num)
-    return elements_by_number['symbol'][num]
+    return _symbol_by_number[num]
 
 def element_label_to_number(label):
     '''Attempt to convert a label (name, symbol, or atomic number) to atomic number'''
@@ -153,19 +176,19 @@ def element_label_to_number(label):
         if isinstance(label, str):
             if len(label) <= 3:
                 # Probably a symbol
-                return elements_by_symbol['number'][label.title()]
+                return _number_by_symbol[label.title()]
             else:
                 # Probaably a name
-                return elements_by_name['number'][label.title()]
+                return _number_by_name[label.title()]
         else:
             # Probably an atomic number
             return int(label)
-    except (IndexError,ValueError):
+    except (LookupError,ValueError):
         pass
     
     # try atomic symbol
     try:
-        return elements_by_symbol['number'][label.title()]
+        return _number_by_symbol[label.title()]
     except KeyError:
         pass
     
@@ -177,11 +200,40 @@ def element_label_to_number(label):
     
     # Try name
     try:
-        return elements_by_name['number'][label.title()]
+        return _number_by_name[label.title()]
     except KeyError:
         pass
     
     raise ValueError('could not identify {!r} as an element'.format(label))
-        
-        
-    
+
+def element_labels_to_numbers(labels):
+    '''Convert an array of labels (names, symbols, or atomic numbers) to an
+    array of atomic numbers. Each distinct label is identified only once.'''
+    unique_labels, inverse = np.unique(np.asarray(labels), return_inverse=True)
+    unique_numbers = np.array([element_label_to_number(label) for label in unique_labels.tolist()],
+                              dtype=np.intp)
+    return unique_numbers[inverse].reshape(np.shape(labels))
+
+def element_numbers_to_symbols(numbers):
+    '''Convert an array of atomic numbers to an array of symbols'''
+    return element_symbols[_checked_numbers(numbers)]
+
+def element_numbers_to_masses(numbers):
+    '''Convert an array of atomic numbers to an array of masses'''
+    return element_masses[_checked_numbers(numbers)]
+
+def element_labels_to_symbols(labels):
+    '''Convert an array of labels (names, symbols, or atomic numbers) to an
+    array of symbols'''
+    return element_symbols[element_labels_to_numbers(labels)]
+
+def element_labels_to_masses(labels):
+    '''Convert an array of labels (names, symbols, or atomic numbers) to an
+    array of masses'''
+    return element_masses[element_labels_to_numbers(labels)]
+
+def _checked_numbers(numbers):
+    numbers = np.asarray(numbers, dtype=np.intp)
+    if numbers.size and (numbers.min() < 1 or numbers.max() >= len(element_symbols)):
+        raise ValueError('atomic number out of range')
+    return numbers
@@ -6,11 +6,14 @@ Created on Wed Jun 28 13:51:03 2017
 @author: mzwier
 """
 
-import argparse, subprocess, re, os, sys, textwrap        
+import argparse, collections, subprocess, re, os, sys, textwrap        
+
+from pipeline_trace import Tracer, null_tracer
+from orbital_manifest import EV_PER_HARTREE, OrbitalEntry, manifest_filename, write_manifest
 
 class OrcaPlotException(RuntimeError):
     def __init__(self, *args, stdout, stderr):
-        super(OrcaPlotException).__init__(*args)
+        super().__init__(*args)
         self.stdout = stdout
         self.stderr = stderr
         
@@ -24,8 +27,9 @@ class OrcaPlotInterface:
     '''Output file: minimal.mo0a.cube'''
     re_outputfile = re.compile(r'Output file:\s+(.+)$')
     
-    def __init__(self, gbwfile, n_points=None, logfile=None):
+    def __init__(self, gbwfile, n_points=None, logfile=None, tracer=None):
         self.gbwfile = gbwfile
+        self.tracer = tracer or null_tracer
         self.orca_encoding = self.default_orca_encoding
         self.orca_plot_command = self.default_orca_plot_command
         self.n_orbitals = None
@@ -48,10 +52,11 @@ class OrcaPlotInterface:
             self.logfile.write(input_bytes)
         
         args = [self.orca_plot_command, self.gbwfile, '-i']
-        pop = subprocess.Popen(args,
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = pop.communicate(input_bytes)
+        with self.tracer.span('orca_plot'):
+            pop = subprocess.Popen(args,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = self.tracer.communicate(pop, input_bytes)
         if self.logfile:
             self.logfile.write('>>>\n'.encode(self.orca_encoding))
             self.logfile.write(stdout)
@@ -77,36 +82,45 @@ class OrcaPlotInterface:
             raise OrcaPlotException('Cannot determine number of orbitals', 
                                     stdout=stdout, stderr=stderr)
             
-    def save_orbital_cube(self, orbital):
+    def save_orbital_cube(self, orbital, spin='alpha'):
         script='2\n{orbital:d}\n5\n7\n'.format(orbital=orbital)
+        if spin == 'beta':
+            # Operator 1 selects beta orbitals of an unrestricted wavefunction
+            script = '3\n1\n' + script
         if self.n_points:
             script+='4\n{}\n'.format(self.n_points)
         script += '10\n'
-        stdout, stderr = self.run_orca_plot(script)
-        for line in stdout.splitlines():
-            m = self.re_outputfile.search(line)
-            if m:
-                return m.group(1)
-        else:
-            raise OrcaPlotException('Cannot determine output file name',
-                                    stdout=stdout, stderr=stderr)
+        with self.tracer.span('save_orbital_cube', mo=orbital, spin=spin) as span:
+            stdout, stderr = self.run_orca_plot(script)
+            for line in stdout.splitlines():
+                m = self.re_outputfile.search(line)
+                if m:
+                    cubefile = m.group(1)
+                    if self.tracer.enabled:
+                        span.set(bytes=os.path.getsize(cubefile))
+                    return cubefile
+            else:
+                raise OrcaPlotException('Cannot determine output file name',
+                                        stdout=stdout, stderr=stderr)
 
 class JmolCmdLineInterface:
     default_jmol_command = 'jmol'
     default_jmol_encoding = 'UTF8'
     
-    def __init__(self):
+    def __init__(self, tracer=None):
         self.jmol_command = self.default_jmol_command
         self.jmol_encoding = self.default_jmol_encoding
+        self.tracer = tracer or null_tracer
         
     def run_jmol_script(self, script):
         script = script.encode(self.jmol_encoding)
         
         args = [self.jmol_command, '-i', '-o', '-n', '-s', '-']
-        pop = subprocess.Popen(args,
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = pop.communicate(script)
+        with self.tracer.span('jmol'):
+            pop = subprocess.Popen(args,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = self.tracer.communicate(pop, script)
         stdout_text = stdout.decode(self.jmol_encoding)
         stderr_text = stderr.decode(self.jmol_encoding)
         rc = pop.wait()
@@ -119,7 +133,10 @@ class JmolCmdLineInterface:
         
     def cube_to_jvxl(self, cubefile, jvxlfile = None):
         jvxlfile, script = self.cube_to_jvxl_script(cubefile, jvxlfile)
-        self.run_jmol_script(script)
+        with self.tracer.span('cube_to_jvxl') as span:
+            self.run_jmol_script(script)
+            if self.tracer.enabled:
+                span.set(bytes=os.path.getsize(jvxlfile))
         return jvxlfile
         
     def cube_to_jvxl_script(self, cubefile, jvxlfile = None):
@@ -159,97 +176,350 @@ def parse_orbital_range(n_mos, mos):
     return list(sorted(nmos))
             
             
+OrbitalInfo = collections.namedtuple('OrbitalInfo', ['nmo', 'occupation', 'energy'])
+
+class OrbitalSelectionError(ValueError):
+    pass
+
+def default_orca_output(gbwfile):
+    '''The ORCA output file next to gbwfile (same name, .out extension), if any'''
+    outfile = os.path.splitext(gbwfile)[0] + '.out'
+    return outfile if os.path.exists(outfile) else None
+
+'''   0   2.0000     -20.550725      -559.2146 '''
+re_orbital_energy = re.compile(r'^\s*(\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s*$')
+
+def read_orbital_energies(outfile):
+    '''Read the last ORBITAL ENERGIES table of an ORCA output file. Returns a
+    dict mapping 'alpha' (and, for unrestricted wavefunctions, 'beta') to a list
+    of OrbitalInfo, with energies in Eh. By default ORCA only prints the
+    first few virtual orbitals, so the lists may be shorter than the number
+    of orbitals in the GBW file.'''
+    orbitals = None
+    in_table = False
+    with open(outfile, 'rt') as infile:
+        for line in infile:
+            stripped = line.strip()
+            if stripped == 'ORBITAL ENERGIES':
+                # Later tables (e.g. after a geometry step) replace earlier ones
+                orbitals = {'alpha': []}
+                spin = 'alpha'
+                in_table = True
+            elif not in_table:
+                continue
+            elif stripped == 'SPIN UP ORBITALS':
+                spin = 'alpha'
+            elif stripped == 'SPIN DOWN ORBITALS':
+                spin = 'beta'
+                orbitals['beta'] = []
+            elif not stripped or stripped.startswith('NO ') or set(stripped) == {'-'}:
+                continue
+            else:
+                m = re_orbital_energy.match(line)
+                if m:
+                    orbitals[spin].append(OrbitalInfo(int(m.group(1)), float(m.group(2)),
+                                                      float(m.group(3))))
+                else:
+                    in_table = False
+    if not orbitals or not orbitals['alpha']:
+        raise OrbitalSelectionError('no orbital energies found in {}'.format(outfile))
+    return orbitals
+
+'''HOMO, LUMO, HOMO-10, LUMO+2'''
+re_frontier_orbital = re.compile(r'^(HOMO|LUMO)\s*(?:([+-])\s*(\d+))?$', re.IGNORECASE)
+'''-15eV, +5 eV, -0.25Eh'''
+re_energy_bound = re.compile(r'^([+-]?(?:\d+\.?\d*|\.\d+))\s*(eV|Eh)$', re.IGNORECASE)
+re_range_separator = re.compile(r'\.\.|\s+to\s+')
+
+def _frontier_index(orbitals, bound):
+    m = re_frontier_orbital.match(bound)
+    if not m:
+        return None
+    occupied = [orbital.nmo for orbital in orbitals if orbital.occupation > 0]
+    if not occupied:
+        raise OrbitalSelectionError('no occupied orbitals')
+    homo = max(occupied)
+    index = homo if m.group(1).upper() == 'HOMO' else homo + 1
+    if m.group(3):
+        offset = int(m.group(3))
+        index += offset if m.group(2) == '+' else -offset
+    return index
+
+def _energy_bound(bound):
+    m = re_energy_bound.match(bound)
+    if not m:
+        return None
+    energy = float(m.group(1))
+    return energy / EV_PER_HARTREE if m.group(2).lower() == 'ev' else energy
+
+def select_orbitals(orbitals, spec, n_mos):
+    '''Return the set of MO numbers selected by spec from orbitals (a list of
+    OrbitalInfo for one spin). spec is one of "occupied", "virtual", a
+    frontier orbital such as "HOMO-2", or an inclusive range of frontier
+    orbitals ("HOMO-10..LUMO+10") or of energies in eV or Eh
+    ("-15eV..5eV", "-15 eV to +5 eV").'''
+    spec = spec.strip()
+    if spec.lower() in ('occ', 'occupied'):
+        return {orbital.nmo for orbital in orbitals if orbital.occupation > 0}
+    elif spec.lower() in ('virt', 'virtual'):
+        return {orbital.nmo for orbital in orbitals if orbital.occupation == 0}
+
+    bounds = [bound.strip() for bound in re_range_separator.split(spec)]
+    if len(bounds) > 2:
+        raise OrbitalSelectionError('invalid orbital selection {!r}'.format(spec))
+
+    indices = [_frontier_index(orbitals, bound) for bound in bounds]
+    if None not in indices:
+        lo, hi = min(indices), max(indices)
+        return set(range(max(lo, 0), min(hi + 1, n_mos)))
+
+    energies = [_energy_bound(bound) for bound in bounds]
+    if len(bounds) == 2 and None not in energies:
+        lo, hi = min(energies), max(energies)
+        return {orbital.nmo for orbital in orbitals if lo <= orbital.energy <= hi}
+
+    raise OrbitalSelectionError('invalid orbital selection {!r}; expected e.g. HOMO-10..LUMO+10, '
+                                '-15eV..5eV, occupied or virtual'.format(spec))
+
+def spin_list(spin):
+    return ['alpha', 'beta'] if spin == 'both' else [spin]
+
+def selected_orbitals(n_mos, mos=None, selections=None, spin='alpha', orbital_energies=None):
+    '''Return a sorted list of (spin, MO number) pairs to plot, from either
+    explicit MO numbers and ranges (see parse_orbital_range) or selections
+    (see select_orbitals), which need the orbital energies from
+    read_orbital_energies. With neither, all orbitals are plotted.'''
+    spins = spin_list(spin)
+    if not selections:
+        return [(spin, nmo) for spin in spins for nmo in parse_orbital_range(n_mos, mos)]
+    if mos:
+        raise OrbitalSelectionError('give either MO numbers or selections, not both')
+    if orbital_energies is None:
+        raise OrbitalSelectionError('selecting orbitals needs orbital energies from an ORCA '
+                                    'output file')
+
+    selected = []
+    for spin in spins:
+        if spin not in orbital_energies:
+            raise OrbitalSelectionError('no {} orbitals; the wavefunction is restricted'.format(spin))
+        nmos = set()
+        for spec in selections:
+            nmos.update(select_orbitals(orbital_energies[spin], spec, n_mos))
+        selected.extend((spin, nmo) for nmo in sorted(nmos))
+    return selected
+
+def orbital_entry(spin, nmo, jvxlfile, orbital_energies=None):
+    '''Manifest entry for a JVXL file, with the energy and occupation of the
+    orbital if they are known'''
+    energy = occupation = None
+    orbitals = (orbital_energies or {}).get(spin, [])
+    # Orbitals are listed in order, but the table may stop short
+    if nmo < len(orbitals) and orbitals[nmo].nmo == nmo:
+        energy, occupation = orbitals[nmo].energy, orbitals[nmo].occupation
+    return OrbitalEntry(nmo, spin, energy, occupation, jvxlfile, os.path.getsize(jvxlfile))
+
+def orbital_label(spin, nmo):
+    '''Label in the style of orca_plot output files: 12a, 12b'''
+    return '{:d}{}'.format(nmo, spin[0])
+
+def save_compact_cube(cubefile, downsample=None, tracer=null_tracer, nmo=None, spin='alpha'):
+    '''Keep a compact (compressed float32, optionally downsampled) copy of a cube file'''
+    # cube_io needs NumPy, so only import it when compact cubes are requested
+    from cube_io import compact_cube
+    with tracer.span('compact_cube', mo=nmo, spin=spin) as span:
+        compactfile = compact_cube(cubefile, downsample=downsample)
+        if tracer.enabled:
+            span.set(bytes=os.path.getsize(compactfile))
+    return compactfile
+
+def jmol_isosurface_commands(nmo, jvxlfile, spin='alpha'):
+    '''Jmol commands to load (hidden) the isosurface for MO nmo'''
+    mo_id = 'mo{:d}'.format(nmo) if spin == 'alpha' else 'mo{:d}b'.format(nmo)
+    return ('isosurface ID {} {}\n'.format(mo_id, jvxlfile)
+            +'isosurface {} off\n'.format(mo_id))
+
+verbose = False
+
 def vprint(*args, **kwargs):
     global verbose
     if verbose:
         print(*args,**kwargs)
     
 
-parser = argparse.ArgumentParser()
-parser.add_argument('gbwfile', help='Wavefunction file')
-parser.add_argument('mos', nargs='*', 
-                    help='Molecular orbitals to plot. Each MOS entry can be an integer, '
-                        +'a range of integers M-N (inclusive), or the open range M- to '
-                        +'plot all orbitals >= M. (Default: all)')
-parser.add_argument('-N', '--npts', type=int, help='Number of grid points.')
-parser.add_argument('-b', '--batch', action='store_true',
-                    help='Create all cube files then process them all in the same Jmol '
-                        +'process. More time efficient but less space efficient.')
-parser.add_argument('-s', '--jmol-script', help='Filename of Jmol script to write.')
-parser.add_argument('-S', '--no-jmol-script', action='store_true', 
-                    help='Do not write Jmol script')
-parser.add_argument('-L', '--orcalog', help='Write orca_plot output to ORCALOG.')                    
-parser.add_argument('-v', '--verbose', action='store_true', 
-                    help='Display progress and extra information.')
-
-args = parser.parse_args()
-gbwfilename = args.gbwfile
-jmolfilename = args.jmol_script or os.path.splitext(os.path.basename(gbwfilename))[0] + '.jmol'
-verbose = args.verbose
-write_jmol = not args.no_jmol_script
-
-orcaplot = OrcaPlotInterface(gbwfilename, n_points = args.npts, logfile=args.orcalog)
-jmol = JmolCmdLineInterface()
-n_mos = orcaplot.get_n_orbitals()
-
-vprint('Orca file {} contains {:d} orbitals'.format(gbwfilename, n_mos))
-vprint('Structure file is {}'.format(orcaplot.xyzfile))
-
-mos = parse_orbital_range(n_mos, args.mos)
-for nmo in mos:
-    if nmo < 0 or nmo >= n_mos:
-        print('Invalid MO specified: {}'.format(nmo), file=sys.stderr)
-        sys.exit(1)
-
-if verbose:
-    vprint('Plotting the following orbitals:')
-    if sys.stdout.isatty():
-        print('\n'.join(textwrap.wrap(str(mos))))
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gbwfile', help='Wavefunction file')
+    parser.add_argument('mos', nargs='*', 
+                        help='Molecular orbitals to plot. Each MOS entry can be an integer, '
+                            +'a range of integers M-N (inclusive), or the open range M- to '
+                            +'plot all orbitals >= M. (Default: all, or those chosen with '
+                            +'--select)')
+    parser.add_argument('-e', '--select', action='append', metavar='SPEC',
+                        help='Plot orbitals selected by energy or occupation instead of by number: '
+                            +'a range of frontier orbitals (HOMO-10..LUMO+10), an energy window '
+                            +'in eV or Eh ("-15 eV to +5 eV", --select=-15eV..5eV), occupied or '
+                            +'virtual. May be given multiple times. Energies and occupations '
+                            +'are read from the ORCA output file.')
+    parser.add_argument('--spin', choices=['alpha', 'beta', 'both'], default='alpha',
+                        help='Spin of the orbitals to plot (default: %(default)s)')
+    parser.add_argument('-O', '--orca-output', 
+                        help='ORCA output file to read orbital energies from (default: the .out '
+                            +'file next to GBWFILE)')
+    parser.add_argument('-N', '--npts', type=int, help='Number of grid points.')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Create all cube files then process them all in the same Jmol '
+                            +'process. More time efficient but less space efficient.')
+    parser.add_argument('-s', '--jmol-script', help='Filename of Jmol script to write.')
+    parser.add_argument('-S', '--no-jmol-script', action='store_true', 
+                        help='Do not write Jmol script')
+    parser.add_argument('-M', '--manifest',
+                        help='Filename of orbital manifest (see orbital_manifest.py) to write, '
+                            +'for jmol_orbital_browser.py (default: GBWFILE basename + '
+                            +'.orbitals.json)')
+    parser.add_argument('--no-manifest', action='store_true', help='Do not write a manifest')
+    parser.add_argument('-C', '--compact-cubes', action='store_true',
+                        help='Keep a compact copy (compressed float32, see cube_io.py) of each '
+                            +'cube file before it is deleted.')
+    parser.add_argument('--compact-downsample', type=int, metavar='FACTOR',
+                        help='Average blocks of FACTOR^3 grid points in compact cube copies '
+                            +'to make a coarser preview grid (implies -C).')
+    parser.add_argument('-L', '--orcalog', help='Write orca_plot output to ORCALOG.')                    
+    parser.add_argument('-v', '--verbose', action='store_true', 
+                        help='Display progress and extra information.')
+    parser.add_argument('-T', '--trace', 
+                        help='Record timing of each step (orca_plot, Jmol, file operations) '
+                            +'to TRACE and print a summary at the end.')
+    parser.add_argument('--trace-format', choices=['jsonl', 'chrome'], default='jsonl',
+                        help='Format of the trace file: JSON lines, or Chrome trace format '
+                            +'for chrome://tracing or Perfetto (default: %(default)s)')
+    return parser
+
+def run(args):
+    global verbose
+    
+    gbwfilename = args.gbwfile
+    jmolfilename = args.jmol_script or os.path.splitext(os.path.basename(gbwfilename))[0] + '.jmol'
+    verbose = args.verbose
+    write_jmol = not args.no_jmol_script
+    compact_cubes = args.compact_cubes or args.compact_downsample is not None
+
+    tracer = Tracer() if args.trace else null_tracer
+    orcaplot = OrcaPlotInterface(gbwfilename, n_points = args.npts, logfile=args.orcalog, 
+                                 tracer=tracer)
+    jmol = JmolCmdLineInterface(tracer=tracer)
+    n_mos = orcaplot.get_n_orbitals()
+
+    vprint('Orca file {} contains {:d} orbitals'.format(gbwfilename, n_mos))
+    vprint('Structure file is {}'.format(orcaplot.xyzfile))
+
+    # Orbital energies are needed to select orbitals, and otherwise only
+    # used to annotate the manifest
+    orbital_energies = None
+    orcaoutput = args.orca_output or default_orca_output(gbwfilename)
+    try:
+        if not orcaoutput:
+            raise OrbitalSelectionError('no ORCA output file found for {}; use --orca-output'
+                                        .format(gbwfilename))
+        orbital_energies = read_orbital_energies(orcaoutput)
+        vprint('Read orbital energies from {}'.format(orcaoutput))
+    except (OSError, OrbitalSelectionError) as e:
+        if args.select:
+            print(e, file=sys.stderr)
+            return 1
+        vprint('Manifest will not include orbital energies: {}'.format(e))
+
+    try:
+        mos = selected_orbitals(n_mos, args.mos, args.select, args.spin, orbital_energies)
+    except OrbitalSelectionError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for (spin, nmo) in mos:
+        if nmo < 0 or nmo >= n_mos:
+            print('Invalid MO specified: {}'.format(nmo), file=sys.stderr)
+            return 1
+
+    if verbose:
+        vprint('Plotting the following orbitals:')
+        labels = ' '.join(orbital_label(spin, nmo) for (spin, nmo) in mos)
+        if sys.stdout.isatty():
+            print('\n'.join(textwrap.wrap(labels)))
+        else:
+            print(labels)
+
+
+    if write_jmol:
+        jmolfile = open(jmolfilename, 'wt')
+        jmolfile.write('load {}\n'.format(orcaplot.xyzfile))
+
+    manifest_entries = []
+    if args.batch:
+        scripts = []
+        cubefiles = []
+        vprint('Processing all orbitals together')
+        for (spin, nmo) in mos:
+            cubefile = orcaplot.save_orbital_cube(nmo, spin)
+            cubefiles.append(cubefile)
+            vprint('  Created cube file {}'.format(cubefile))
+            if compact_cubes:
+                compactfile = save_compact_cube(cubefile, args.compact_downsample, tracer, nmo, spin)
+                vprint('  Saved compact copy {}'.format(compactfile))
+            jvxlfile, script = jmol.cube_to_jvxl_script(cubefile)
+            scripts.append(script)
+            if write_jmol:
+                jmolfile.write(jmol_isosurface_commands(nmo, jvxlfile, spin))
+        script = '\n'.join(scripts)
+        vprint('  Converting all cube files to jvxl files')
+        with tracer.span('cube_to_jvxl', n_mos=len(cubefiles)) as span:
+            jmol.run_jmol_script(script)
+            if tracer.enabled:
+                span.set(bytes=sum(os.path.getsize(os.path.splitext(cubefile)[0] + '.jvxl')
+                                   for cubefile in cubefiles))
+        for (spin, nmo), cubefile in zip(mos, cubefiles):
+            vprint('  Deleting {}'.format(cubefile))
+            with tracer.span('delete_cube'):
+                os.unlink(cubefile)
+            manifest_entries.append(orbital_entry(spin, nmo, os.path.splitext(cubefile)[0] + '.jvxl',
+                                                  orbital_energies))
     else:
-        print(mos)
+        vprint('Processing one orbital at a time')
+        for (spin, nmo) in mos:
+            with tracer.span('mo', mo=nmo, spin=spin):
+                vprint('Processing MO {}'.format(orbital_label(spin, nmo)))
+                cubefile = orcaplot.save_orbital_cube(nmo, spin)
+                vprint('  Saved {}'.format(cubefile))
+                if compact_cubes:
+                    compactfile = save_compact_cube(cubefile, args.compact_downsample, tracer, nmo,
+                                                    spin)
+                    vprint('  Saved compact copy {}'.format(compactfile))
+                jvxlfile = jmol.cube_to_jvxl(cubefile)
+                vprint('  Converted {} to {}'.format(cubefile,jvxlfile))
+                with tracer.span('delete_cube', mo=nmo, spin=spin):
+                    os.unlink(cubefile)
+                vprint('  Deleted {}'.format(cubefile))
+                manifest_entries.append(orbital_entry(spin, nmo, jvxlfile, orbital_energies))
 
+            if write_jmol:
+                jmolfile.write(jmol_isosurface_commands(nmo, jvxlfile, spin))
 
-if write_jmol:
-    jmolfile = open(jmolfilename, 'wt')
-    jmolfile.write('load {}\n'.format(orcaplot.xyzfile))
-    
-if args.batch:
-    scripts = []
-    cubefiles = []
-    vprint('Processing all orbitals together')
-    for nmo in mos:
-        cubefile = orcaplot.save_orbital_cube(nmo)
-        cubefiles.append(cubefile)
-        vprint('  Created cube file {}'.format(cubefile))
-        jvxlfile, script = jmol.cube_to_jvxl_script(cubefile)
-        scripts.append(script)
-        if write_jmol:
-            mo_id = 'mo{:d}'.format(nmo)
-            jmolfile.write('isosurface ID {} {}\n'.format(mo_id, jvxlfile))
-            jmolfile.write('isosurface {} off\n'.format(mo_id))
-    script = '\n'.join(scripts)
-    vprint('  Converting all cube files to jvxl files')
-    jmol.run_jmol_script(script)
-    for cubefile in cubefiles:
-        vprint('  Deleting {}'.format(cubefile))
-        os.unlink(cubefile)
-else:
-    vprint('Processing one orbital at a time')
-    for nmo in mos:
-        vprint('Processing MO {}'.format(nmo))
-        cubefile = orcaplot.save_orbital_cube(nmo)
-        vprint('  Saved {}'.format(cubefile))
-        jvxlfile = jmol.cube_to_jvxl(cubefile)
-        vprint('  Converted {} to {}'.format(cubefile,jvxlfile))
-        os.unlink(cubefile)
-        vprint('  Deleted {}'.format(cubefile))
-        
-        if write_jmol:
-            mo_id = 'mo{:d}'.format(nmo)
-            jmolfile.write('isosurface ID {} {}\n'.format(mo_id, jvxlfile))
-            jmolfile.write('isosurface {} off\n'.format(mo_id))
-
-if write_jmol:
-    vprint('Wrote Jmol script to {}'.format(jmolfilename))
-    jmolfile.close()
-    
\ No newline at end of file
+    if write_jmol:
+        vprint('Wrote Jmol script to {}'.format(jmolfilename))
+        jmolfile.close()
+
+    if not args.no_manifest:
+        manifest = args.manifest or manifest_filename(gbwfilename)
+        write_manifest(manifest, gbwfilename, orcaplot.xyzfile, manifest_entries)
+        vprint('Wrote orbital manifest to {}'.format(manifest))
+
+    if args.trace:
+        tracer.write(args.trace, args.trace_format)
+        vprint('Wrote trace to {}'.format(args.trace))
+        tracer.print_summary()
+
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+'''
+Generate orbital isosurfaces (JVXL files) for many wavefunction files at once.
+
+Every (GBW file, MO, spin) combination is an independent task. Tasks from
+all files are scheduled together on a pool of workers, each running
+orca_plot and then Jmol for one orbital. A task is only started when the
+scratch disk and memory can accommodate the cube file it will create (which
+grows as the cube of the number of grid points) on top of the tasks already
+running.
+
+Completed tasks are recorded in a state file, so an interrupted run can
+simply be restarted with the same arguments. One Jmol script and one
+orbital manifest (see orbital_manifest.py) are written per structure once
+all of its orbitals are done.
+'''
+
+import argparse, collections, concurrent.futures, json, os, shutil, subprocess, sys, threading
+
+from gen_orbitals import (OrcaPlotInterface, JmolCmdLineInterface, OrcaPlotException,
+                          OrbitalSelectionError, default_orca_output, read_orbital_energies, selected_orbitals,
+                          orbital_entry, orbital_label, jmol_isosurface_commands,
+                          save_compact_cube)
+from input_files import expand_inputs
+from orbital_manifest import manifest_filename, write_manifest
+from pipeline_trace import Tracer, null_tracer
+
+# orca_plot writes about 13 characters per grid point to a cube file
+CUBE_BYTES_PER_POINT = 13
+# orca_plot and Jmol each hold the grid as double precision numbers
+GRID_MEMORY_BYTES_PER_POINT = 16
+# Grid size used by orca_plot when none is specified
+DEFAULT_NPTS = 40
+
+MiB = 1024*1024
+
+Task = collections.namedtuple('Task', ['gbwfile', 'nmo', 'spin'])
+
+def available_memory():
+    '''Memory available for new processes, in bytes, or None if unknown'''
+    try:
+        with open('/proc/meminfo', 'rt') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class ResourceGate:
+    '''Admit tasks only while the scratch disk and memory they are estimated
+    to need, plus that reserved by tasks already running, fit within what is
+    free (less a safety margin).'''
+
+    def __init__(self, scratch_dir, min_free_disk, min_free_memory):
+        self.scratch_dir = scratch_dir
+        self.min_free_disk = min_free_disk
+        self.min_free_memory = min_free_memory
+        self.reserved_disk = 0
+        self.reserved_memory = 0
+
+    def try_reserve(self, disk, memory):
+        free_disk = shutil.disk_usage(self.scratch_dir).free - self.reserved_disk
+        if free_disk - disk < self.min_free_disk:
+            return False
+
+        free_memory = available_memory()
+        if free_memory is not None:
+            if free_memory - self.reserved_memory - memory < self.min_free_memory:
+                return False
+
+        self.reserved_disk += disk
+        self.reserved_memory += memory
+        return True
+
+    def release(self, disk, memory):
+        self.reserved_disk -= disk
+        self.reserved_memory -= memory
+
+class CompletionLog:
+    '''Append-only record of completed tasks, used to resume interrupted runs'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''Return a mapping of completed Task -> JVXL file, for tasks whose
+        JVXL file still exists'''
+        completed = {}
+        try:
+            with open(self.filename, 'rt') as logfile:
+                for line in logfile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partial line from an interrupted write
+                        continue
+                    if os.path.exists(record['jvxl']):
+                        task = Task(record['gbw'], record['mo'], record.get('spin', 'alpha'))
+                        completed[task] = record['jvxl']
+        except FileNotFoundError:
+            pass
+        return completed
+
+    def record(self, task, jvxlfile):
+        with self._lock, open(self.filename, 'at') as logfile:
+            logfile.write(json.dumps({'gbw': task.gbwfile, 'mo': task.nmo, 'spin': task.spin,
+                                      'jvxl': jvxlfile}) + '\n')
+
+def process_orbital(orcaplot, jmol, nmo, spin='alpha', compact=False, compact_downsample=None):
+    cubefile = orcaplot.save_orbital_cube(nmo, spin)
+    try:
+        if compact:
+            save_compact_cube(cubefile, compact_downsample, orcaplot.tracer, nmo, spin)
+        jvxlfile = jmol.cube_to_jvxl(cubefile)
+    finally:
+        os.unlink(cubefile)
+    return jvxlfile
+
+def write_jmol_script(jmolfilename, xyzfile, jvxlfiles):
+    with open(jmolfilename, 'wt') as jmolfile:
+        jmolfile.write('load {}\n'.format(xyzfile))
+        for (spin, nmo) in sorted(jvxlfiles):
+            jmolfile.write(jmol_isosurface_commands(nmo, jvxlfiles[spin, nmo], spin))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generate JVXL orbital isosurfaces for many '
+                                                 'wavefunction files, in parallel.')
+    parser.add_argument('gbwfiles', nargs='*',
+                        help='Wavefunction files or glob patterns (quote them to keep the '
+                            +'shell from expanding them).')
+    parser.add_argument('-f', '--files-from', metavar='MANIFEST',
+                        help='Read wavefunction files or glob patterns from MANIFEST, one per line.')
+    parser.add_argument('-m', '--mos', nargs='+',
+                        help='Molecular orbitals to plot for each file, as for gen_orbitals.py. '
+                            +'(Default: all, or those chosen with --select)')
+    parser.add_argument('-e', '--select', action='append', metavar='SPEC',
+                        help='Plot orbitals selected by energy or occupation, as for '
+                            +'gen_orbitals.py (e.g. HOMO-10..LUMO+10). Energies are read from '
+                            +'the .out file next to each wavefunction file.')
+    parser.add_argument('--spin', choices=['alpha', 'beta', 'both'], default='alpha',
+                        help='Spin of the orbitals to plot (default: %(default)s)')
+    parser.add_argument('-N', '--npts', type=int, help='Number of grid points.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Maximum number of orbitals to process at once (default: %(default)s)')
+    parser.add_argument('--min-free-disk', type=float, default=1024,
+                        help='Scratch space (MiB) to leave free, in addition to space '
+                            +'reserved for cube files being written (default: %(default)s)')
+    parser.add_argument('--min-free-memory', type=float, default=1024,
+                        help='Memory (MiB) to leave free (default: %(default)s)')
+    parser.add_argument('--task-memory', type=float, default=512,
+                        help='Memory (MiB) needed by each task in addition to its grid, '
+                            +'mostly for the Jmol JVM (default: %(default)s)')
+    parser.add_argument('-C', '--compact-cubes', action='store_true',
+                        help='Keep a compact copy (compressed float32, see cube_io.py) of each '
+                            +'cube file before it is deleted.')
+    parser.add_argument('--compact-downsample', type=int, metavar='FACTOR',
+                        help='Average blocks of FACTOR^3 grid points in compact cube copies '
+                            +'(implies -C).')
+    parser.add_argument('--state', default='gen_orbitals_batch.done',
+                        help='File recording completed orbitals, used to resume an '
+                            +'interrupted run (default: %(default)s)')
+    parser.add_argument('-S', '--no-jmol-script', action='store_true',
+                        help='Do not write Jmol scripts')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help='Do not write orbital manifests')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Display progress and extra information.')
+    parser.add_argument('-T', '--trace',
+                        help='Record timing of each step to TRACE and print a summary at the end. '
+                            +'CPU times are those of the worker running the step and of its own '
+                            +'orca_plot and Jmol processes, so steps run at the same time do not '
+                            +'count each other\'s.')
+    parser.add_argument('--trace-format', choices=['jsonl', 'chrome'], default='jsonl',
+                        help='Format of the trace file (default: %(default)s)')
+    return parser
+
+def run(args):
+    def vprint(*vargs, **kwargs):
+        if args.verbose:
+            print(*vargs, **kwargs)
+
+    gbwfiles = expand_inputs(args.gbwfiles, args.files_from)
+    if not gbwfiles:
+        print('No wavefunction files given', file=sys.stderr)
+        return 1
+
+    # Output files are named after the wavefunction file and written to the
+    # current directory, so names must not collide
+    basenames = collections.Counter(os.path.splitext(os.path.basename(gbwfile))[0]
+                                    for gbwfile in gbwfiles)
+    duplicates = sorted(basename for basename, count in basenames.items() if count > 1)
+    if duplicates:
+        print('Wavefunction files must have distinct names; duplicated: {}'
+              .format(', '.join(duplicates)), file=sys.stderr)
+        return 1
+
+    compact_cubes = args.compact_cubes or args.compact_downsample is not None
+    tracer = Tracer() if args.trace else null_tracer
+    jmol = JmolCmdLineInterface(tracer=tracer)
+    orcaplots = {gbwfile: OrcaPlotInterface(gbwfile, n_points=args.npts, tracer=tracer)
+                 for gbwfile in gbwfiles}
+
+    npts = args.npts or DEFAULT_NPTS
+    task_disk = npts**3 * CUBE_BYTES_PER_POINT
+    task_memory = npts**3 * GRID_MEMORY_BYTES_PER_POINT + int(args.task_memory * MiB)
+    gate = ResourceGate(os.getcwd(), int(args.min_free_disk * MiB), int(args.min_free_memory * MiB))
+
+    completion_log = CompletionLog(args.state)
+    completed = completion_log.load()
+
+    def count_orbitals(gbwfile):
+        try:
+            return orcaplots[gbwfile].get_n_orbitals()
+        except (OSError, subprocess.CalledProcessError, OrcaPlotException) as e:
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        n_orbitals = dict(zip(gbwfiles, pool.map(count_orbitals, gbwfiles)))
+
+        # A missing or corrupt wavefunction file should not stop the others
+        skipped = [gbwfile for gbwfile in gbwfiles if isinstance(n_orbitals[gbwfile], Exception)]
+        for gbwfile in skipped:
+            print('{}: cannot read orbitals, skipping: {}'.format(gbwfile, n_orbitals[gbwfile]),
+                  file=sys.stderr)
+        gbwfiles = [gbwfile for gbwfile in gbwfiles if gbwfile not in skipped]
+
+        tasks = []
+        orbital_energies = {}
+        for gbwfile in gbwfiles:
+            try:
+                orbital_energies[gbwfile] = None
+                orcaoutput = default_orca_output(gbwfile)
+                if orcaoutput:
+                    orbital_energies[gbwfile] = read_orbital_energies(orcaoutput)
+                elif args.select:
+                    raise OrbitalSelectionError('no ORCA output file found for {}'.format(gbwfile))
+                mos = selected_orbitals(n_orbitals[gbwfile], args.mos, args.select, args.spin,
+                                        orbital_energies[gbwfile])
+            except (OSError, OrbitalSelectionError) as e:
+                print('{}: {}'.format(gbwfile, e), file=sys.stderr)
+                return 1
+            invalid = [nmo for (spin, nmo) in mos if nmo < 0 or nmo >= n_orbitals[gbwfile]]
+            if invalid:
+                print('Invalid MO(s) specified for {}: {}'.format(gbwfile, invalid), file=sys.stderr)
+                return 1
+            tasks.extend(Task(gbwfile, nmo, spin) for (spin, nmo) in mos)
+
+        pending = collections.deque(task for task in tasks if task not in completed)
+        vprint('{:d} wavefunction files, {:d} orbitals, {:d} already done'
+               .format(len(gbwfiles), len(tasks), len(tasks) - len(pending)))
+        vprint('Each orbital needs about {:.0f} MiB scratch, {:.0f} MiB memory'
+               .format(task_disk / MiB, task_memory / MiB))
+
+        running = {}
+        failed = []
+        while pending or running:
+            while pending and len(running) < args.jobs and gate.try_reserve(task_disk, task_memory):
+                task = pending.popleft()
+                future = pool.submit(process_orbital, orcaplots[task.gbwfile], jmol, task.nmo,
+                                     task.spin, compact_cubes, args.compact_downsample)
+                running[future] = task
+
+            if not running:
+                print('Not enough free scratch space or memory to process even one orbital; '
+                      +'stopping with {:d} orbitals left'.format(len(pending)), file=sys.stderr)
+                break
+
+            done, not_done = concurrent.futures.wait(running,
+                                                     return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                gate.release(task_disk, task_memory)
+                try:
+                    jvxlfile = future.result()
+                except Exception as e:
+                    print('Failed to process MO {} of {}: {}'
+                          .format(orbital_label(task.spin, task.nmo), task.gbwfile, e),
+                          file=sys.stderr)
+                    failed.append(task)
+                else:
+                    completed[task] = jvxlfile
+                    completion_log.record(task, jvxlfile)
+                    vprint('  {} MO {} -> {}'.format(task.gbwfile,
+                                                     orbital_label(task.spin, task.nmo), jvxlfile))
+
+    for gbwfile in gbwfiles:
+        jvxlfiles = {(task.spin, task.nmo): completed[task] for task in tasks
+                     if task.gbwfile == gbwfile and task in completed}
+        if len(jvxlfiles) < sum(1 for task in tasks if task.gbwfile == gbwfile):
+            vprint('Not writing Jmol script or manifest for incomplete {}'.format(gbwfile))
+            continue
+        if not args.no_jmol_script:
+            jmolfilename = os.path.splitext(os.path.basename(gbwfile))[0] + '.jmol'
+            write_jmol_script(jmolfilename, orcaplots[gbwfile].xyzfile, jvxlfiles)
+            vprint('Wrote Jmol script to {}'.format(jmolfilename))
+        if not args.no_manifest:
+            manifest = manifest_filename(gbwfile)
+            write_manifest(manifest, gbwfile, orcaplots[gbwfile].xyzfile,
+                           [orbital_entry(spin, nmo, jvxlfile, orbital_energies[gbwfile])
+                            for (spin, nmo), jvxlfile in jvxlfiles.items()])
+            vprint('Wrote orbital manifest to {}'.format(manifest))
+
+    if args.trace:
+        tracer.write(args.trace, args.trace_format)
+        tracer.print_summary()
+
+    remaining = len(tasks) - sum(1 for task in tasks if task in completed)
+    if remaining:
+        print('{:d} orbitals not done ({:d} failed); rerun to resume'.format(remaining, len(failed)),
+              file=sys.stderr)
+    if skipped:
+        print('{:d} wavefunction files skipped: {}'.format(len(skipped), ', '.join(skipped)),
+              file=sys.stderr)
+    if remaining or skipped:
+        return 1
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
+
+if __name__ == '__main__':
+    main()
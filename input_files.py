@@ -0,0 +1,35 @@
+'''
+Expansion of input file arguments for the batch scripts.
+
+gen_orbitals_batch.py and vibrational_spectrum.py take their input files as
+names or glob patterns on the command line and/or in a manifest file. This
+module only uses the standard library, so importing it is cheap, including
+in worker processes.
+'''
+
+import glob, sys
+
+def expand_inputs(inputs, manifest=None):
+    '''Expand file names, glob patterns, and the contents of a manifest (one
+    file name or glob pattern per line; # starts a comment) into a list of
+    files, without duplicates.'''
+    patterns = list(inputs)
+    if manifest:
+        with open(manifest, 'rt') as manifest_file:
+            for line in manifest_file:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    patterns.append(line)
+
+    filenames = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                print('Warning: {!r} matches no files'.format(pattern), file=sys.stderr)
+            filenames.extend(matches)
+        else:
+            filenames.append(pattern)
+
+    seen = set()
+    return [filename for filename in filenames if not (filename in seen or seen.add(filename))]
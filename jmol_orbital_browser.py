@@ -7,7 +7,10 @@ Created on Fri Jun 30 14:10:18 2017
 """
 
 import subprocess, argparse, os, sys, socket, re, collections, time
-import tkinter as tk
+
+from orbital_manifest import MANIFEST_SUFFIX, EV_PER_HARTREE, ManifestError, read_manifest
+# tkinter is imported only when the window is built, so that listing
+# orbitals and argument errors do not pay for loading Tk
 
 JVXLInfo = collections.namedtuple('JVXLInfo', ['filename', 'jmol_label', 'list_entry'])
 
@@ -38,13 +41,14 @@ def get_free_port():
     s.close()
     return port
 
-class ScrolledList(tk.Frame):
+class ScrolledList:
     def __init__(self, parent=None):
-        super().__init__(parent)
-        self.pack(expand=tk.YES, fill=tk.BOTH)
+        import tkinter as tk
+        self.frame = tk.Frame(parent)
+        self.frame.pack(expand=tk.YES, fill=tk.BOTH)
         
-        self.scroll_bar = tk.Scrollbar(self)
-        self.list_box = tk.Listbox(self, relief=tk.SUNKEN)
+        self.scroll_bar = tk.Scrollbar(self.frame)
+        self.list_box = tk.Listbox(self.frame, relief=tk.SUNKEN)
         self.scroll_bar.config(command=self.list_box.yview)
         self.list_box.config(yscrollcommand=self.scroll_bar.set)
         self.scroll_bar.pack(side=tk.RIGHT, fill=tk.Y)
@@ -88,6 +92,41 @@ class JmolOrbitalControl:
             sys.exit(1)        
         else:
             return xyzfiles[0]
+
+    def find_manifest(self):
+        '''Return the orbital manifest in the current directory, or None if
+        there is none'''
+        manifests = [filename for filename in os.listdir() if filename.endswith(MANIFEST_SUFFIX)]
+        if len(manifests) > 1:
+            sys.stderr.write('Found multiple orbital manifests in the current directory.\n'
+                            +'Specify one with the -m option.\n')
+            sys.exit(1)
+        return manifests[0] if manifests else None
+
+    def load_manifest(self, filename):
+        '''Build the orbital list from a manifest written by gen_orbitals.py,
+        without looking at the JVXL files themselves. Returns the manifest.'''
+        manifest = read_manifest(filename)
+        both_spins = len({entry.spin for entry in manifest.orbitals}) > 1
+
+        jvxl_files = []
+        for entry in sorted(manifest.orbitals, key=lambda entry: (entry.spin, entry.nmo)):
+            # Same labels as the Jmol script written by gen_orbitals.py
+            jmol_label = 'mo{:d}'.format(entry.nmo) if entry.spin == 'alpha' \
+                         else 'mo{:d}b'.format(entry.nmo)
+            list_entry = 'MO {:d}'.format(entry.nmo)
+            if both_spins:
+                list_entry += entry.spin[0]
+            if entry.energy is not None:
+                list_entry += '   {:.3f} eV'.format(entry.energy * EV_PER_HARTREE)
+            if entry.occupation is not None:
+                list_entry += '   occ {:.2f}'.format(entry.occupation)
+            jvxl_files.append(JVXLInfo(filename = entry.jvxlfile,
+                                       jmol_label = jmol_label,
+                                       list_entry = list_entry))
+
+        self.jvxl_files = jvxl_files
+        return manifest
             
     def get_jvxlfiles(self, filenames):
         jvxl_dict = dict()
@@ -179,6 +218,7 @@ class JmolOrbitalControl:
         self.jmol_socket.send(message.encode(self.jmol_encoding))
         
     def build_window(self):
+        import tkinter as tk
         self.window = tk.Tk()
         self.window.title('Jmol orbital control')
         self.scrolled_list = ScrolledList(self.window)
@@ -196,6 +236,7 @@ class JmolOrbitalControl:
         
     
     def deselect_all(self):
+        import tkinter as tk
         self.scrolled_list.list_box.select_clear(0,tk.END)
         self.hide_mos(set(self.jvxl_displayed))
     
@@ -255,11 +296,16 @@ def vprint(*args, **kwargs):
         
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--coordinates', 
-                    help='Coordinate file to load. Defaults to any file ending in .xyz. '
+                    help='Coordinate file to load. Defaults to the structure file in the '
+                        +'manifest, or to any file ending in .xyz. '
                         +'If multiple .xyz files are found, the program will not run.')
+parser.add_argument('-m', '--manifest',
+                    help='Orbital manifest written by gen_orbitals.py. Defaults to the file '
+                        +'ending in {} in the current directory, if no '.format(MANIFEST_SUFFIX)
+                        +'jvxl files are given.')
 parser.add_argument('jvxlfile', nargs='*',
-                    help='jvxl MO files to load. Defaults to all files ending in .jvxl. '
-                        +'An attempt is made to sort these files numerically.')
+                    help='jvxl MO files to load, if there is no manifest. Defaults to all files '
+                        +'ending in .jvxl. An attempt is made to sort these files numerically.')
 parser.add_argument('-v', '--verbose', action='store_true',
                     help="Be descriptive about what's going on")
                         
@@ -269,10 +315,23 @@ verbose = args.verbose
 
 joc = JmolOrbitalControl()
 
-joc.coord_file = args.coordinates or joc.find_xyzfile()
+manifest_file = args.manifest
+if not manifest_file and not args.jvxlfile:
+    manifest_file = joc.find_manifest()
+
+if manifest_file:
+    try:
+        manifest = joc.load_manifest(manifest_file)
+    except (OSError, ManifestError) as e:
+        sys.stderr.write('{}\n'.format(e))
+        sys.exit(1)
+    vprint('Using orbital manifest {}'.format(manifest_file))
+    joc.coord_file = args.coordinates or manifest.structure_file
+else:
+    joc.coord_file = args.coordinates or joc.find_xyzfile()
+    joc.get_jvxlfiles(args.jvxlfile)
 vprint('Using {} as structure file'.format(joc.coord_file))
 
-joc.get_jvxlfiles(args.jvxlfile)
 if verbose:
     vprint('Found the following orbitals:')
     for jvxl_file in joc.jvxl_files:
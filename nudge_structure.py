@@ -4,25 +4,56 @@ import sys
 import numpy as np
 import argparse
 
-import scipy.constants
-ANGSTROMS_PER_BOHR = scipy.constants.value('Bohr radius') * 1e10
+from xyz_io import write_xyz_frame
+
+# CODATA 2018 Bohr radius; hard-coded to avoid importing scipy at start-up
+ANGSTROMS_PER_BOHR = 0.529177210903
+KCAL_PER_MOL_PER_HARTREE = 627.509474
+
+# Blocks of a .hess file needed to nudge a structure; the (large) Cartesian
+# Hessian is only parsed to predict energies
+nudge_blocks = ('vibrational_frequencies', 'normal_modes', 'atoms')
+prediction_blocks = nudge_blocks + ('hessian',)
 
 class OrcaHessian:
 
     def __init__(self):
-        pass
+        self.hessian = None
+        self.filename = None
+        self.energy = None
+        self.ir_frequencies = None
+        self.ir_intensities = None
+        self.raman_frequencies = None
+        self.raman_activities = None
 
-    def read(self, hessfile):
+    def read(self, hessfile, blocks=None):
+        '''Parse an ORCA .hess file. If blocks is given, only the named
+        blocks (e.g. 'ir_spectrum', without the $) are parsed.'''
+        parsers = {'$hessian': self._parse_hessian,
+                   '$vibrational_frequencies': self._parse_vibrational_frequencies,
+                   '$normal_modes': self._parse_normal_modes,
+                   '$atoms': self._parse_atoms,
+                   '$act_energy': self._parse_act_energy,
+                   '$ir_spectrum': self._parse_ir_spectrum,
+                   '$raman_spectrum': self._parse_raman_spectrum}
+        if blocks is not None:
+            parsers = {name: parser for name, parser in parsers.items() if name[1:] in blocks}
+
+        self.filename = getattr(hessfile, 'name', None)
         for line in hessfile:
-            if line.startswith('$vibrational_frequencies'):
-                self._parse_vibrational_frequencies(hessfile)
-            elif line.startswith('$normal_modes'):
-                self._parse_normal_modes(hessfile)
-            elif line.startswith('$atoms'):
-                self._parse_atoms(hessfile)
-            else:
-                continue
-        self._finalize()
+            if line.startswith('$'):
+                parser = parsers.get(line.split()[0])
+                if parser:
+                    parser(hessfile)
+        if '$normal_modes' in parsers and '$atoms' in parsers:
+            self._finalize()
+
+    def _parse_hessian(self, hessfile):
+        # Cartesian second derivatives, in Eh/bohr^2. ORCA gives only one
+        # dimension for this square block.
+        self.hessian = self.parse_block(hessfile, square=True)
+        if self.hessian.ndim != 2 or self.hessian.shape[0] != self.hessian.shape[1]:
+            raise ValueError('$hessian block is not square: shape {}'.format(self.hessian.shape))
 
     def _parse_vibrational_frequencies(self, hessfile):
         #nfreq = int(hessfile.readline())
@@ -30,6 +61,23 @@ class OrcaHessian:
         #self.frequencies = np.array(freqs)
         self.frequencies = self.parse_block(hessfile)
 
+    def _parse_act_energy(self, hessfile):
+        self.energy = float(next(hessfile).split()[0])
+
+    def _parse_ir_spectrum(self, hessfile):
+        table = self.parse_table(hessfile)
+        self.ir_frequencies = table[:, 0]
+        # ORCA 5 and later list eps, intensity (km/mol), T**2, TX, TY, TZ;
+        # earlier versions only T**2 and its components, so T**2 serves as
+        # a relative intensity
+        self.ir_intensities = table[:, 2] if table.shape[1] >= 7 else table[:, 1]
+
+    def _parse_raman_spectrum(self, hessfile):
+        # Frequency, activity, depolarization ratio
+        table = self.parse_table(hessfile)
+        self.raman_frequencies = table[:, 0]
+        self.raman_activities = table[:, 1]
+
     def _parse_normal_modes(self, hessfile):
         nmodearray = self.parse_block(hessfile)
         nmode = nmodearray.shape[1]
@@ -72,9 +120,44 @@ class OrcaHessian:
 
         self.unweighted_nmode_displacements = unweighted_displacements
 
+    def mode_force_constants(self, modes, other=None):
+        '''Force constants (Eh/Angstrom^2) coupling the unit Cartesian
+        displacements of modes, i.e. the Cartesian Hessian projected onto
+        them. If other (another OrcaHessian) is given, its Hessian is
+        projected onto the modes of this one.'''
+        hessian = (other or self).hessian
+        if hessian is None:
+            raise ValueError('no $hessian block in Hessian file')
+        vectors = self.unweighted_nmode_displacements[modes].reshape(len(modes), -1)
+        return vectors @ hessian @ vectors.T / ANGSTROMS_PER_BOHR**2
+
+    def mode_displacement(self, coords):
+        '''Express the displacement from the reference geometry to coords as
+        a combination of the unit mode displacements. Returns the mode
+        number and amplitude (Angstroms) if it is along a single mode.'''
+        delta = (coords - self.coords).ravel()
+        vectors = self.unweighted_nmode_displacements.reshape(len(self.frequencies), -1)
+        amplitudes = np.linalg.lstsq(vectors.T, delta, rcond=None)[0]
+        imode = int(np.argmax(abs(amplitudes)))
+        residual = np.linalg.norm(delta - amplitudes[imode] * vectors[imode])
+        if abs(amplitudes[imode]) < 1e-4 or residual > 1e-3 + 0.01 * abs(amplitudes[imode]):
+            raise ValueError('geometry is not displaced along a single mode')
+        return imode, amplitudes[imode]
+
     @staticmethod
-    def parse_block(infile):
+    def parse_table(infile):
+        '''Parse a row count followed by that many unlabelled rows of numbers'''
+        nrows = int(next(infile).split()[0])
+        return np.array([next(infile).split() for irow in range(nrows)], np.float64).reshape(nrows, -1)
+
+    @staticmethod
+    def parse_block(infile, square=False):
+        '''Parse a block of labelled rows (one dimension) or labelled columns
+        and rows (two dimensions). If square is true, a block with a single
+        dimension N is read as N x N.'''
         shape = [int(dim) for dim in next(infile).strip().split()]
+        if square and len(shape) == 1:
+            shape = shape * 2
         array = np.empty(shape, np.float64)
 
         if array.ndim == 1:
@@ -94,69 +177,228 @@ class OrcaHessian:
         return array
     
 
-parser = argparse.ArgumentParser(description='Nudge a structure along one or more modes. '
-                                             'Produces an XYZ file in Angstroms. '
-                                             'By default, nudges along all imaginary modes.')
-parser.add_argument('hessian_file', help='ORCA hessian (.hess) file')
-parser.add_argument('output_file', help='XYZ output file', nargs='?')
-parser.add_argument('-l', '--list', action='store_true',
-                    help='List frequencies and exit.')
-parser.add_argument('-m', '--mode', '--modes', nargs='+',
-                    help='Mode(s) to nudge along. Can be an integer, or N:d, where N is '
-                         'the mode number and d is the displacement in Angstroms. '
-                         'By default, nudges along all imaginary modes.')
-parser.add_argument('-d', '--displacement', type=float, default=0.1,
-                    help='Default distance for the nudge(s) in Angstroms (default: %(default)s)')
-args = parser.parse_args()
-
-hessfile = open(args.hessian_file, 'rt')
-orcaparser = OrcaHessian()
-orcaparser.read(hessfile)
-
-if args.list:
-    print('Frequencies:')
-    for ifreq, freq in enumerate(orcaparser.frequencies):
-        print('    {:6d}: {:10.1f} cm-1{}'.format(ifreq, freq, ' (*)' if freq < 0 else ''))
-    sys.exit(0)
-
-
-modes = []
-displacements = []
-
-if not args.mode:
-    for imode in range(len(orcaparser.frequencies)):
-        if orcaparser.frequencies[imode] < 0:
+def load_hessian(filename, blocks=None):
+    orcaparser = OrcaHessian()
+    with open(filename, 'rt') as hessfile:
+        orcaparser.read(hessfile, blocks)
+    return orcaparser
+
+class DisplacementEnergyModel:
+    '''Predict the energy change for displacements along a few normal modes
+    from a Taylor expansion about the reference geometry:
+
+        dE = 1/2 sum_ij K_ij d_i d_j + 1/6 sum_ijk F_ijk d_i d_j d_k
+
+    where d are amplitudes (Angstroms) of the unit displacements used by
+    nudge_structure.py. K is the Cartesian Hessian projected onto the
+    modes, so couplings between modes are included. The cubic constants F
+    are optional and come from finite differences of Hessians computed at
+    geometries displaced along individual modes (e.g. with this script).
+    Cubic constants not involving any such mode are taken as zero.
+    '''
+
+    def __init__(self, hessian, modes):
+        self.hessian = hessian
+        self.modes = list(modes)
+        self.force_constants = hessian.mode_force_constants(self.modes)
+        self.cubic_constants = None
+
+    def add_cubic_terms(self, displaced_hessians):
+        '''Estimate cubic constants from Hessians (OrcaHessian objects) at
+        displaced geometries. Both signs of displacement along a mode give
+        a central difference; one sign gives a forward difference from the
+        reference Hessian. Returns the modes differentiated.'''
+        by_mode = {}
+        for displaced in displaced_hessians:
+            try:
+                imode, amplitude = self.hessian.mode_displacement(displaced.coords)
+            except ValueError as e:
+                raise ValueError('{}: {}'.format(displaced.filename, e))
+            if imode in self.modes:
+                by_mode.setdefault(imode, []).append((amplitude, displaced))
+
+        m = len(self.modes)
+        # slices[i] holds dK/dd_i for differentiated modes i
+        slices = {}
+        for imode, points in by_mode.items():
+            plus = [point for point in points if point[0] > 0]
+            minus = [point for point in points if point[0] < 0]
+            if plus and minus:
+                (h1, hess1), (h0, hess0) = plus[0], minus[0]
+                k0 = self.hessian.mode_force_constants(self.modes, hess0)
+            else:
+                (h1, hess1), h0 = points[0], 0.0
+                k0 = self.force_constants
+            k1 = self.hessian.mode_force_constants(self.modes, hess1)
+            slices[self.modes.index(imode)] = (k1 - k0) / (h1 - h0)
+
+        # Average the estimates of each symmetric cubic constant
+        cubic = np.zeros((m, m, m))
+        for i in range(m):
+            for j in range(m):
+                for k in range(m):
+                    estimates = [slices[a][b, c] for (a, b, c) in ((i, j, k), (j, i, k), (k, i, j))
+                                 if a in slices]
+                    if estimates:
+                        cubic[i, j, k] = sum(estimates) / len(estimates)
+        self.cubic_constants = cubic
+        return sorted(self.modes[i] for i in slices)
+
+    def predict(self, displacements):
+        '''Energy changes (Eh) for an array of displacements, of shape
+        (candidates, modes) in Angstroms'''
+        d = np.asarray(displacements, np.float64)
+        energies = 0.5 * np.einsum('ci,ij,cj->c', d, self.force_constants, d, optimize=True)
+        if self.cubic_constants is not None:
+            energies += np.einsum('ijk,ci,cj,ck->c', self.cubic_constants, d, d, d,
+                                  optimize=True) / 6
+        return energies
+
+def parse_grid_spec(spec):
+    '''Parse N:START:STOP:COUNT (COUNT evenly spaced amplitudes) or
+    N:d1,d2,... into a mode number and an array of amplitudes'''
+    fields = spec.split(':')
+    try:
+        if len(fields) == 4:
+            return int(fields[0]), np.linspace(float(fields[1]), float(fields[2]), int(fields[3]))
+        elif len(fields) == 2:
+            return int(fields[0]), np.array([float(field) for field in fields[1].split(',')])
+    except ValueError:
+        pass
+    raise ValueError('invalid grid specification {!r}; expected N:START:STOP:COUNT or '
+                     'N:d1,d2,...'.format(spec))
+
+def displacement_grid(amplitudes):
+    '''All combinations of the given per-mode amplitudes, as an array of
+    shape (candidates, modes)'''
+    mesh = np.meshgrid(*amplitudes, indexing='ij')
+    return np.stack([axis.ravel() for axis in mesh], axis=-1)
+
+def print_predictions(modes, displacements, energies, stdout, top=None):
+    order = np.argsort(energies, kind='stable') if top else np.arange(len(energies))
+    order = order[:top] if top else order
+    print(''.join('{:>10s}'.format('mode {}'.format(imode)) for imode in modes)
+          + '{:>14s}{:>14s}'.format('dE (Eh)', 'dE (kcal/mol)'), file=stdout)
+    for icand in order:
+        print(''.join('{:10.4f}'.format(d) for d in displacements[icand])
+              + '{:14.6f}{:14.3f}'.format(energies[icand],
+                                          energies[icand] * KCAL_PER_MOL_PER_HARTREE), file=stdout)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Nudge a structure along one or more modes. '
+                                                 'Produces an XYZ file in Angstroms. '
+                                                 'By default, nudges along all imaginary modes.')
+    parser.add_argument('hessian_file', help='ORCA hessian (.hess) file')
+    parser.add_argument('output_file', help='XYZ output file', nargs='?')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List frequencies and exit.')
+    parser.add_argument('-m', '--mode', '--modes', nargs='+',
+                        help='Mode(s) to nudge along. Can be an integer, or N:d, where N is '
+                             'the mode number and d is the displacement in Angstroms. '
+                             'By default, nudges along all imaginary modes.')
+    parser.add_argument('-d', '--displacement', type=float, default=0.1,
+                        help='Default distance for the nudge(s) in Angstroms (default: %(default)s)')
+    parser.add_argument('-p', '--predict', action='store_true',
+                        help='Instead of writing a structure, print the energy change predicted '
+                             'from the Hessian for the nudge, or for each displacement in the '
+                             'grid given with --grid.')
+    parser.add_argument('-g', '--grid', action='append', metavar='N:START:STOP:COUNT',
+                        help='Predict energy changes for all combinations of displacements along '
+                             'the given modes: COUNT amplitudes from START to STOP Angstroms along '
+                             'mode N, or a list of amplitudes as N:d1,d2,... '
+                             'May be given multiple times; implies --predict.')
+    parser.add_argument('-c', '--cubic', nargs='+', metavar='HESSIAN_FILE',
+                        help='Add cubic terms to predictions, from Hessians computed at geometries '
+                             'displaced along single modes (ideally by +d and -d).')
+    parser.add_argument('--top', type=int,
+                        help='Only report the TOP predictions with the lowest energy, lowest first.')
+    return parser
+
+def run(args, stdout=None, stderr=None, load_hessian=load_hessian):
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    predict = args.predict or args.grid
+    orcaparser = load_hessian(args.hessian_file, prediction_blocks if predict else nudge_blocks)
+
+    if args.list:
+        print('Frequencies:', file=stdout)
+        for ifreq, freq in enumerate(orcaparser.frequencies):
+            print('    {:6d}: {:10.1f} cm-1{}'.format(ifreq, freq, ' (*)' if freq < 0 else ''),
+                  file=stdout)
+        return 0
+
+
+    modes = []
+    displacements = []
+
+    # A grid names its own modes, so imaginary modes are only the default
+    # without one
+    if not args.mode and not args.grid:
+        for imode in range(len(orcaparser.frequencies)):
+            if orcaparser.frequencies[imode] < 0:
+                modes.append(imode)
+                displacements.append(args.displacement)
+
+        if not modes:
+            print('No imaginary frequencies and no modes specified. Nothing to do.', file=stdout)
+            return 0
+    elif args.mode:
+        for modestr in args.mode:
+            imode, sep, displacement = modestr.partition(':')
+            imode = int(imode)
+            if displacement:
+                displacement = float(displacement)
+            else:
+                displacement = args.displacement
             modes.append(imode)
-            displacements.append(args.displacement)
-
-    if not modes:
-        print('No imaginary frequencies and no modes specified. Nothing to do.')
-        sys.exit(0)
-else:
-    for modestr in args.mode:
-        imode, displacement = modestr.split(':')
-        imode = int(imode)
-        if displacement:
-            displacement = float(displacement)
-        else:
-            displacement = args.displacement
-        modes.append(imode)
-        displacements.append(displacement)
-
-if not args.output_file:
-    print('Output file required unless only listing modes.', file=sys.stderr)
-    sys.exit(1)
-
-coords = np.copy(orcaparser.coords)
-for imode, displacement in zip(modes, displacements):
-    print('  Displacing mode {} by {} Angstroms'.format(imode, displacement))
-
-    coords += displacement * orcaparser.unweighted_nmode_displacements[imode]
-
-natoms = len(orcaparser.atoms)
-with open(args.output_file, 'wt') as xyzfile:
-    xyzfile.write('{:d}\n'.format(natoms))
-    xyzfile.write('  Generated from {} by displacing {} modes\n'.format(args.hessian_file, len(modes)))
-    for iatom in range(natoms):
-        xyzfile.write('{:3s} {:f} {:f} {:f}\n'.format(orcaparser.atoms[iatom], *coords[iatom]))
-                  
+            displacements.append(displacement)
+
+    if predict:
+        try:
+            if args.grid:
+                modes, amplitudes = zip(*(parse_grid_spec(spec) for spec in args.grid))
+                candidates = displacement_grid(amplitudes)
+            else:
+                candidates = np.array([displacements])
+            for imode in modes:
+                if not 0 <= imode < len(orcaparser.frequencies):
+                    raise ValueError('no mode {}'.format(imode))
+            model = DisplacementEnergyModel(orcaparser, modes)
+            kind = 'harmonic'
+            if args.cubic:
+                displaced = [load_hessian(filename, ('atoms', 'hessian')) for filename in args.cubic]
+                differentiated = model.add_cubic_terms(displaced)
+                kind = 'harmonic + cubic along modes {}'.format(
+                    ', '.join(str(imode) for imode in differentiated) or 'none')
+        except ValueError as e:
+            print(e, file=stderr)
+            return 1
+
+        energies = model.predict(candidates)
+        print('Predicted energy changes for {:d} displacements ({}):'.format(len(candidates), kind),
+              file=stdout)
+        print_predictions(modes, candidates, energies, stdout, args.top)
+        return 0
+
+    if not args.output_file:
+        print('Output file required unless only listing modes.', file=stderr)
+        return 1
+
+    coords = np.copy(orcaparser.coords)
+    for imode, displacement in zip(modes, displacements):
+        print('  Displacing mode {} by {} Angstroms'.format(imode, displacement), file=stdout)
+
+        coords += displacement * orcaparser.unweighted_nmode_displacements[imode]
+
+    with open(args.output_file, 'wt') as xyzfile:
+        write_xyz_frame(xyzfile, coords, orcaparser.atoms,
+                        '  Generated from {} by displacing {} modes'.format(args.hessian_file, len(modes)))
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
+
+if __name__ == '__main__':
+    main()
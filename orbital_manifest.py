@@ -0,0 +1,72 @@
+'''
+Manifest of the orbital isosurfaces generated for one structure.
+
+gen_orbitals.py writes a manifest alongside the JVXL files it creates,
+listing the structure file and, for each orbital, its number, spin, energy,
+occupation, JVXL file and size. jmol_orbital_browser.py builds its orbital
+list from the manifest, without scanning the directory or opening any JVXL
+file.
+
+The manifest is a small JSON file, BASENAME.orbitals.json:
+
+    {"version": 1, "gbw": "mol.gbw", "structure": "mol.xyz",
+     "columns": ["mo", "spin", "energy", "occupation", "jvxl", "size"],
+     "orbitals": [[41, "alpha", -0.2512, 2.0, "mol.mo41a.jvxl", 183209], ...]}
+
+Energies are in Eh. Energy and occupation are null when the ORCA output
+did not list them. File names are relative to the manifest's directory.
+'''
+
+import collections, json, os
+
+MANIFEST_SUFFIX = '.orbitals.json'
+MANIFEST_VERSION = 1
+MANIFEST_COLUMNS = ['mo', 'spin', 'energy', 'occupation', 'jvxl', 'size']
+
+EV_PER_HARTREE = 27.211386245988
+
+OrbitalEntry = collections.namedtuple('OrbitalEntry', ['nmo', 'spin', 'energy', 'occupation',
+                                                       'jvxlfile', 'size'])
+Manifest = collections.namedtuple('Manifest', ['gbwfile', 'structure_file', 'orbitals'])
+
+class ManifestError(ValueError):
+    pass
+
+def manifest_filename(gbwfile):
+    '''Default manifest name for a wavefunction file, in the current directory'''
+    return os.path.splitext(os.path.basename(gbwfile))[0] + MANIFEST_SUFFIX
+
+def write_manifest(filename, gbwfile, structure_file, orbitals):
+    '''Write a manifest for orbitals (OrbitalEntry tuples), replacing any
+    existing manifest atomically'''
+    directory = os.path.dirname(os.path.abspath(filename))
+    relative = lambda path: os.path.relpath(os.path.abspath(path), directory)
+    rows = [[entry.nmo, entry.spin, entry.energy, entry.occupation, relative(entry.jvxlfile),
+             entry.size]
+            for entry in sorted(orbitals, key=lambda entry: (entry.spin, entry.nmo))]
+    manifest = {'version': MANIFEST_VERSION,
+                'gbw': gbwfile,
+                'structure': relative(structure_file),
+                'columns': MANIFEST_COLUMNS,
+                'orbitals': rows}
+    tmpfilename = filename + '.tmp'
+    with open(tmpfilename, 'wt') as outfile:
+        outfile.write(json.dumps(manifest, separators=(',', ':')) + '\n')
+    os.replace(tmpfilename, filename)
+
+def read_manifest(filename):
+    '''Read a manifest, returning a Manifest whose file names are usable from
+    the current directory'''
+    try:
+        with open(filename, 'rt') as infile:
+            manifest = json.load(infile)
+    except ValueError as e:
+        raise ManifestError('{} is not a valid orbital manifest: {}'.format(filename, e))
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('columns') != MANIFEST_COLUMNS:
+        raise ManifestError('{} is not a version {:d} orbital manifest'
+                            .format(filename, MANIFEST_VERSION))
+
+    directory = os.path.dirname(filename)
+    orbitals = [OrbitalEntry(nmo, spin, energy, occupation, os.path.join(directory, jvxlfile), size)
+                for (nmo, spin, energy, occupation, jvxlfile, size) in manifest['orbitals']]
+    return Manifest(manifest.get('gbw'), os.path.join(directory, manifest['structure']), orbitals)
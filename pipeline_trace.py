@@ -0,0 +1,184 @@
+'''
+Lightweight timing and tracing of pipeline steps.
+
+A Tracer records spans: named, possibly nested, intervals with wall time,
+CPU time of the thread running the span (of the whole process where
+RUSAGE_THREAD is unavailable), CPU time and peak resident memory of the child
+processes run inside the span, and arbitrary attributes such as the MO
+number or bytes written. Child processes are reaped by Tracer.communicate()
+with os.wait4(), which reports each child's own resource usage; that usage
+is added to the spans open in the calling thread, so children run by other
+threads at the same time are not counted. Spans can be exported as
+JSON lines or as a Chrome trace file (viewable in chrome://tracing or
+Perfetto), and summarized as a table.
+'''
+
+import contextlib, json, os, resource, sys, threading, time
+
+class Span:
+    def __init__(self, name, start, attrs):
+        self.name = name
+        self.start = start
+        self.attrs = attrs
+        self.wall_time = None
+        self.cpu_time = None
+        self.child_cpu_time = None
+        self.child_maxrss_kb = None
+        self.thread_id = threading.get_ident()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def as_dict(self):
+        return {'name': self.name,
+                'start': self.start,
+                'wall_time': self.wall_time,
+                'cpu_time': self.cpu_time,
+                'child_cpu_time': self.child_cpu_time,
+                'child_maxrss_kb': self.child_maxrss_kb,
+                **self.attrs}
+
+class NullSpan:
+    def set(self, **attrs):
+        pass
+
+class NullTracer:
+    '''Stand-in when tracing is disabled; records nothing'''
+    enabled = False
+    _null_span = NullSpan()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        yield self._null_span
+
+    def communicate(self, pop, input=None):
+        return pop.communicate(input)
+
+class Tracer:
+    enabled = True
+
+    def __init__(self):
+        self.spans = []
+        self.epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        # Stack of the spans open in each thread
+        self._local = threading.local()
+
+    # Spans run concurrently by the workers of gen_orbitals_batch.py must
+    # not count each other's CPU time
+    _cpu_time_who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+    @classmethod
+    def _cpu_time(cls):
+        own = resource.getrusage(cls._cpu_time_who)
+        return own.ru_utime + own.ru_stime
+
+    def _open_spans(self):
+        try:
+            return self._local.spans
+        except AttributeError:
+            self._local.spans = []
+            return self._local.spans
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        '''Time the body of a with statement. The span object is yielded so
+        that attributes (e.g. bytes written) can be added from inside.'''
+        span = Span(name, time.perf_counter() - self.epoch, attrs)
+        span.child_cpu_time = 0.0
+        span.child_maxrss_kb = 0
+        open_spans = self._open_spans()
+        open_spans.append(span)
+        cpu0 = self._cpu_time()
+        wall0 = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.wall_time = time.perf_counter() - wall0
+            span.cpu_time = self._cpu_time() - cpu0
+            open_spans.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def communicate(self, pop, input=None):
+        '''Like pop.communicate(input), but reap the child with os.wait4()
+        and add its resource usage to the spans open in this thread'''
+        outputs = {}
+        def read(name, stream):
+            with stream:
+                outputs[name] = stream.read()
+        readers = [threading.Thread(target=read, args=(name, stream))
+                   for (name, stream) in (('stdout', pop.stdout), ('stderr', pop.stderr))
+                   if stream]
+        for reader in readers:
+            reader.start()
+        if pop.stdin:
+            try:
+                with pop.stdin:
+                    if input:
+                        pop.stdin.write(input)
+            except BrokenPipeError:
+                # The child exited without reading all of its input
+                pass
+        for reader in readers:
+            reader.join()
+
+        (pid, status, rusage) = os.wait4(pop.pid, 0)
+        pop.returncode = os.waitstatus_to_exitcode(status)
+        for span in self._open_spans():
+            span.child_cpu_time += rusage.ru_utime + rusage.ru_stime
+            span.child_maxrss_kb = max(span.child_maxrss_kb, rusage.ru_maxrss)
+        return outputs.get('stdout'), outputs.get('stderr')
+
+    def write_jsonl(self, outfile):
+        for span in sorted(self.spans, key=lambda span: span.start):
+            outfile.write(json.dumps(span.as_dict()) + '\n')
+
+    def write_chrome_trace(self, outfile):
+        pid = os.getpid()
+        events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            args = span.as_dict()
+            del args['name'], args['start'], args['wall_time']
+            events.append({'name': span.name,
+                           'ph': 'X',
+                           'ts': span.start * 1e6,
+                           'dur': span.wall_time * 1e6,
+                           'pid': pid,
+                           'tid': span.thread_id,
+                           'args': args})
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outfile)
+
+    def write(self, filename, format='jsonl'):
+        with open(filename, 'wt') as outfile:
+            if format == 'chrome':
+                self.write_chrome_trace(outfile)
+            else:
+                self.write_jsonl(outfile)
+
+    def summary(self):
+        '''Return a table of count, wall time, CPU time and bytes per span name'''
+        totals = {}
+        for span in self.spans:
+            (count, wall, cpu, child_cpu, nbytes) = totals.get(span.name, (0, 0.0, 0.0, 0.0, 0))
+            totals[span.name] = (count + 1,
+                                 wall + span.wall_time,
+                                 cpu + span.cpu_time,
+                                 child_cpu + span.child_cpu_time,
+                                 nbytes + span.attrs.get('bytes', 0))
+
+        lines = ['{:<20s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s} {:>12s}'
+                 .format('step', 'count', 'wall (s)', 'mean (s)', 'cpu (s)', 'child cpu', 'bytes')]
+        for name, (count, wall, cpu, child_cpu, nbytes) in sorted(totals.items(),
+                                                                  key=lambda item: -item[1][1]):
+            lines.append('{:<20s} {:>6d} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12d}'
+                         .format(name, count, wall, wall/count, cpu, child_cpu, nbytes))
+        if self.spans:
+            lines.append('peak child RSS: {:d} kB'.format(max(span.child_maxrss_kb
+                                                              for span in self.spans)))
+        return '\n'.join(lines)
+
+    def print_summary(self, file=None):
+        print(self.summary(), file=file or sys.stdout)
+
+null_tracer = NullTracer()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+'''
+Long-running server for xyz_rmsd.py, nudge_structure.py and
+webmo_to_canonical_xyz.py, plus a thin client to talk to it.
+
+    tool_daemon.py serve [-j WORKERS] [--cache-size N]   # start the server
+    tool_daemon.py rmsd a.xyz b.xyz --noalign            # = xyz_rmsd.py a.xyz b.xyz --noalign
+    tool_daemon.py nudge x.hess out.xyz -m 0:0.2         # = nudge_structure.py ...
+    tool_daemon.py webmo traj.xyz -o out.xyz             # = webmo_to_canonical_xyz.py ...
+    tool_daemon.py stop                                  # shut the server down
+
+The server keeps the QCP kernel, parsed .hess files and parsed XYZ
+structures in memory (in LRU caches keyed on file name, size and
+modification time), and serves requests concurrently from a pool of worker
+threads over a Unix domain socket. Each request is one line of JSON
+({"tool": ..., "argv": [...], "cwd": ...}) answered by one line of JSON
+({"status": ..., "stdout": ..., "stderr": ...}). Trajectories converted
+through the server are read from and written to files (webmo needs an
+input file name and -o), rather than passed through the reply.
+
+The client path only uses the standard library, so it starts quickly.
+'''
+
+import argparse, json, os, socket, sys, tempfile
+
+# tool name -> (module, attributes of the parsed arguments holding file names,
+# or lists of file names)
+tools = {
+    'rmsd':  ('xyz_rmsd', ('xyz1', 'xyz2')),
+    'nudge': ('nudge_structure', ('hessian_file', 'output_file', 'cubic')),
+    'webmo': ('webmo_to_canonical_xyz', ('webmo_xyz', 'output')),
+}
+
+def default_socket_path():
+    return os.environ.get('ORCA_TOOLS_SOCKET',
+                          os.path.join(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()),
+                                       'orca-tools-{:d}.sock'.format(os.getuid())))
+
+class ToolRequestError(RuntimeError):
+    def __init__(self, *args, status):
+        super().__init__(*args)
+        self.status = status
+
+def send_request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode('UTF8') + b'\n')
+            stream.flush()
+            reply = stream.readline()
+    if not reply:
+        raise ConnectionError('server closed the connection without replying')
+    return json.loads(reply.decode('UTF8'))
+
+def call_tool(socket_path, tool, argv):
+    reply = send_request(socket_path, {'tool': tool, 'argv': argv, 'cwd': os.getcwd()})
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+def serve(socket_path, n_workers, cache_size):
+    # Everything heavy is imported here, once, rather than per request
+    import concurrent.futures, functools, importlib, io, socketserver, threading, traceback
+
+    modules = {tool: importlib.import_module(module_name)
+               for tool, (module_name, path_args) in tools.items()}
+    try:
+        modules['rmsd'].load_qcprot()
+    except ImportError as e:
+        print('QCP kernel unavailable ({}); aligned RMSD requests will fail'.format(e),
+              file=sys.stderr)
+
+    def file_key(filename):
+        stat = os.stat(filename)
+        return (filename, stat.st_size, stat.st_mtime_ns)
+
+    @functools.lru_cache(maxsize=cache_size)
+    def _cached_hessian(key, blocks):
+        return modules['nudge'].load_hessian(key[0], blocks)
+
+    @functools.lru_cache(maxsize=cache_size)
+    def _cached_structure(key, iframe):
+        coords = modules['rmsd'].load_structure(key[0], iframe)
+        coords.setflags(write=False)
+        return coords
+
+    loaders = {
+        'rmsd':  {'load_structure': lambda filename, iframe=0: _cached_structure(file_key(filename), iframe)},
+        'nudge': {'load_hessian': lambda filename, blocks=None:
+                      _cached_hessian(file_key(filename), blocks)},
+        'webmo': {},
+    }
+
+    class ParserExit(Exception):
+        def __init__(self, status):
+            super().__init__(status)
+            self.status = status
+
+    def parse_tool_args(tool, argv, stdout, stderr):
+        # argparse normally writes to sys.stdout/sys.stderr and exits;
+        # redirect both into the reply instead
+        parser = modules[tool].build_parser()
+        parser.prog = tools[tool][0] + '.py'
+        def print_help(file=None):
+            argparse.ArgumentParser.print_help(parser, stdout)
+        def exit(status=0, message=None):
+            if message:
+                stderr.write(message)
+            raise ParserExit(status)
+        def error(message):
+            parser.print_usage(stderr)
+            exit(2, '{}: error: {}\n'.format(parser.prog, message))
+        parser.print_help = print_help
+        parser.exit = exit
+        parser.error = error
+        return parser.parse_args(argv)
+
+    def handle_tool_request(request):
+        tool = request['tool']
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        try:
+            if tool not in tools:
+                raise ToolRequestError('unknown tool {!r}'.format(tool), status=2)
+            args = parse_tool_args(tool, request['argv'], stdout, stderr)
+            if tool == 'webmo':
+                # The server's stdin is not the client's, and the reply is
+                # sent in one piece, so trajectories go from file to file
+                if args.webmo_xyz == '-':
+                    raise ToolRequestError('webmo through the server cannot read standard input; '
+                                           'give a file name', status=2)
+                if not args.output:
+                    raise ToolRequestError('webmo through the server needs an output file (-o)',
+                                           status=2)
+            # Relative file names are relative to the client's directory
+            resolve = lambda filename: (os.path.join(request['cwd'], filename)
+                                        if filename and filename != '-' else filename)
+            for path_arg in tools[tool][1]:
+                filename = getattr(args, path_arg)
+                if isinstance(filename, list):
+                    setattr(args, path_arg, [resolve(item) for item in filename])
+                else:
+                    setattr(args, path_arg, resolve(filename))
+            status = modules[tool].run(args, stdout=stdout, stderr=stderr, **loaders[tool])
+        except ParserExit as e:
+            status = e.status
+        except ToolRequestError as e:
+            stderr.write('{}\n'.format(e))
+            status = e.status
+        except OSError as e:
+            stderr.write('{}\n'.format(e))
+            status = 1
+        except Exception:
+            stderr.write(traceback.format_exc())
+            status = 1
+        return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            request = json.loads(line.decode('UTF8'))
+            if request.get('tool') == 'shutdown':
+                reply = {'status': 0, 'stdout': '', 'stderr': ''}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                reply = handle_tool_request(request)
+            self.wfile.write(json.dumps(reply).encode('UTF8') + b'\n')
+
+    class PooledUnixStreamServer(socketserver.UnixStreamServer):
+        '''Serve each connection on a fixed pool of worker threads'''
+        def __init__(self, *args, n_workers, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+
+        def _process_request(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._process_request, request, client_address)
+
+        def server_close(self):
+            super().server_close()
+            self.pool.shutdown(wait=True)
+
+    if os.path.exists(socket_path):
+        try:
+            send_request(socket_path, {'tool': 'ping', 'argv': [], 'cwd': '/'})
+        except (ConnectionError, OSError):
+            # Stale socket left behind by a server that did not exit cleanly
+            os.unlink(socket_path)
+        else:
+            print('A server is already listening on {}'.format(socket_path), file=sys.stderr)
+            return 1
+
+    with PooledUnixStreamServer(socket_path, RequestHandler, n_workers=n_workers) as server:
+        os.chmod(socket_path, 0o600)
+        print('Serving on {} with {:d} workers'.format(socket_path, n_workers), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve (or send requests to) the ORCA tools '
+                                                 'from a persistent process.')
+    parser.add_argument('-s', '--socket', default=default_socket_path(),
+                        help='Unix domain socket to serve on or connect to '
+                            +'(default: $ORCA_TOOLS_SOCKET or %(default)s)')
+    parser.add_argument('command', choices=['serve', 'stop'] + sorted(tools),
+                        help='Start or stop the server, or run a tool through it')
+    parser.add_argument('tool_args', nargs=argparse.REMAINDER,
+                        help='Arguments for the tool (or for "serve")')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve_parser = argparse.ArgumentParser(prog=parser.prog + ' serve')
+        serve_parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                                  help='Number of worker threads (default: %(default)s)')
+        serve_parser.add_argument('--cache-size', type=int, default=128,
+                                  help='Number of parsed files of each kind to keep in memory '
+                                      +'(default: %(default)s)')
+        serve_args = serve_parser.parse_args(args.tool_args)
+        return serve(args.socket, serve_args.workers, serve_args.cache_size)
+
+    try:
+        if args.command == 'stop':
+            return send_request(args.socket, {'tool': 'shutdown'})['status']
+        else:
+            return call_tool(args.socket, args.command, args.tool_args)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print('No server listening on {} (start one with "tool_daemon.py serve")'
+              .format(args.socket), file=sys.stderr)
+        return 1
+    except OSError as e:
+        print('{}: {}'.format(args.socket, e), file=sys.stderr)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
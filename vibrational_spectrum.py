@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+'''
+Build IR (and Raman) spectra of conformer ensembles from ORCA .hess files.
+
+Peak positions and intensities come from the $ir_spectrum (IR intensities
+in km/mol) and $raman_spectrum (Raman activities) blocks, and conformer
+energies from $act_energy. Files are read in parallel, in separate
+processes, parsing only those blocks.
+
+Every peak of every file is then broadened onto one shared wavenumber grid
+with area-normalized Lorentzian or Gaussian line shapes, weighted by the
+Boltzmann population of its conformer, in a few NumPy broadcasts over
+(peaks, grid points) blocks:
+
+    vibrational_spectrum.py conf*.hess -s 0.97 -w 12 -o ensemble_ir.dat
+    vibrational_spectrum.py -f hessfiles.txt --raman --shape gaussian
+
+The output has one line per grid point: the wavenumber, the IR spectrum
+and, with --raman, the Raman spectrum.
+'''
+
+import argparse, concurrent.futures, os, sys
+
+import numpy as np
+
+from input_files import expand_inputs
+from nudge_structure import load_hessian
+
+# Boltzmann constant in Eh/K
+BOLTZMANN_HARTREE_PER_K = 3.166811563e-6
+# Upper bound on the size of the (peaks, grid points) array broadened at once
+BROADEN_BLOCK_ELEMENTS = 1 << 22
+
+spectrum_blocks = ('act_energy', 'ir_spectrum', 'raman_spectrum')
+
+class SpectrumError(ValueError):
+    pass
+
+def load_spectrum_data(filename):
+    '''Read the energy, IR and Raman peaks of one .hess file, as (energy,
+    ir_frequencies, ir_intensities, raman_frequencies, raman_activities);
+    missing data are None'''
+    hessian = load_hessian(filename, spectrum_blocks)
+    return (hessian.energy, hessian.ir_frequencies, hessian.ir_intensities,
+            hessian.raman_frequencies, hessian.raman_activities)
+
+def load_spectra(filenames, n_workers=None):
+    '''Read many .hess files in parallel, returning load_spectrum_data()
+    results in the order of filenames'''
+    if n_workers == 1 or len(filenames) < 2:
+        return [load_spectrum_data(filename) for filename in filenames]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+        chunksize = max(1, len(filenames) // (4 * (n_workers or os.cpu_count() or 1)))
+        return list(pool.map(load_spectrum_data, filenames, chunksize=chunksize))
+
+def boltzmann_weights(energies, temperature):
+    '''Populations of conformers with the given energies (Eh)'''
+    energies = np.asarray(energies, np.float64)
+    exponents = -(energies - energies.min()) / (BOLTZMANN_HARTREE_PER_K * temperature)
+    weights = np.exp(exponents)
+    return weights / weights.sum()
+
+def line_shapes(offsets, fwhm, shape):
+    '''Area-normalized line shape of the given full width at half maximum,
+    evaluated at offsets from the peak centre'''
+    if shape == 'gaussian':
+        sigma = fwhm / (2 * (2 * np.log(2))**0.5)
+        return np.exp(-0.5 * (offsets / sigma)**2) / (sigma * (2 * np.pi)**0.5)
+    else:
+        gamma = fwhm / 2
+        return (gamma / np.pi) / (offsets**2 + gamma**2)
+
+def broaden(grid, centers, heights, fwhm, shape='lorentzian'):
+    '''Sum of line shapes centred at centers with areas heights (1-D
+    arrays of all peaks of all conformers), evaluated on grid'''
+    spectrum = np.zeros_like(grid)
+    block = max(1, BROADEN_BLOCK_ELEMENTS // len(grid))
+    for start in range(0, len(centers), block):
+        offsets = grid[None, :] - centers[start:start+block, None]
+        spectrum += heights[start:start+block] @ line_shapes(offsets, fwhm, shape)
+    return spectrum
+
+def stack_peaks(frequencies, intensities, weights, scale=1.0):
+    '''Flatten the peaks of all conformers into arrays of scaled positions
+    and weighted intensities, dropping imaginary and zero frequencies'''
+    counts = [len(freqs) for freqs in frequencies]
+    centers = np.concatenate(frequencies) * scale
+    heights = np.concatenate(intensities) * np.repeat(weights, counts)
+    real = centers > 0
+    return centers[real], heights[real]
+
+def ensemble_spectrum(filenames, data, grid, fwhm, shape='lorentzian', scale=1.0,
+                      temperature=298.15, energies=None, raman=False):
+    '''IR (and Raman, if requested) spectra of an ensemble. data are
+    load_spectrum_data() results for filenames. Conformers are Boltzmann
+    weighted by their energies (from the files, or from energies, a
+    mapping of filename to energy in Eh), or equally weighted if
+    temperature is None. Returns (ir, raman or None, weights).'''
+    if temperature is None:
+        weights = np.full(len(data), 1 / len(data))
+    else:
+        conformer_energies = []
+        for filename, (energy, *peaks) in zip(filenames, data):
+            energy = energies.get(filename, energy) if energies else energy
+            if energy is None:
+                raise SpectrumError('no energy for {}; give one with --energies or use '
+                                    '--equal-weights'.format(filename))
+            conformer_energies.append(energy)
+        weights = boltzmann_weights(conformer_energies, temperature)
+
+    ir = _broaden_ensemble(filenames, data, 1, 2, 'ir_spectrum', weights, grid, fwhm, shape, scale)
+    raman = (_broaden_ensemble(filenames, data, 3, 4, 'raman_spectrum', weights, grid, fwhm, shape,
+                               scale) if raman else None)
+    return ir, raman, weights
+
+def _broaden_ensemble(filenames, data, ifrequencies, iintensities, block, weights, grid, fwhm,
+                      shape, scale):
+    for filename, item in zip(filenames, data):
+        if item[ifrequencies] is None:
+            raise SpectrumError('no ${} block in {}'.format(block, filename))
+    centers, heights = stack_peaks([item[ifrequencies] for item in data],
+                                   [item[iintensities] for item in data], weights, scale)
+    return broaden(grid, centers, heights, fwhm, shape)
+
+def read_energies(filename):
+    '''Read lines of "HESSFILE ENERGY" (Eh), e.g. free energies to use
+    for weighting instead of the electronic energies in the files'''
+    energies = {}
+    with open(filename, 'rt') as infile:
+        for line in infile:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                energies[fields[0]] = float(fields[1])
+    return energies
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Build the Boltzmann-weighted IR (and Raman) '
+                                                 'spectrum of an ensemble of ORCA .hess files.')
+    parser.add_argument('hessfiles', nargs='*',
+                        help='ORCA .hess files or glob patterns (quote them to keep the shell '
+                            +'from expanding them).')
+    parser.add_argument('-f', '--files-from', metavar='MANIFEST',
+                        help='Read .hess files or glob patterns from MANIFEST, one per line.')
+    parser.add_argument('-o', '--output', help='Output file (default: standard output)')
+    parser.add_argument('--range', nargs=2, type=float, default=[400.0, 4000.0],
+                        metavar=('MIN', 'MAX'),
+                        help='Wavenumber range in cm-1 (default: %(default)s)')
+    parser.add_argument('--step', type=float, default=1.0,
+                        help='Grid spacing in cm-1 (default: %(default)s)')
+    parser.add_argument('-w', '--fwhm', type=float, default=10.0,
+                        help='Full width at half maximum of each peak in cm-1 '
+                            +'(default: %(default)s)')
+    parser.add_argument('--shape', choices=['lorentzian', 'gaussian'], default='lorentzian',
+                        help='Line shape (default: %(default)s)')
+    parser.add_argument('-s', '--scale', type=float, default=1.0,
+                        help='Frequency scaling factor (default: %(default)s)')
+    parser.add_argument('-t', '--temperature', type=float, default=298.15,
+                        help='Temperature in K for Boltzmann weights (default: %(default)s)')
+    parser.add_argument('-e', '--energies', metavar='FILE',
+                        help='Weight by energies (Eh) from FILE, with lines of "HESSFILE ENERGY", '
+                            +'instead of the electronic energies in the .hess files.')
+    parser.add_argument('--equal-weights', action='store_true',
+                        help='Weight all conformers equally')
+    parser.add_argument('--raman', action='store_true',
+                        help='Also build the Raman spectrum (needs $raman_spectrum blocks)')
+    parser.add_argument('--normalize', action='store_true',
+                        help='Scale each spectrum to a maximum of 1')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes reading files (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Report conformer weights')
+    return parser
+
+def run(args, stdout=None, stderr=None):
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    filenames = expand_inputs(args.hessfiles, args.files_from)
+    if not filenames:
+        print('No .hess files given', file=stderr)
+        return 1
+
+    try:
+        energies = read_energies(args.energies) if args.energies else None
+        data = load_spectra(filenames, args.jobs)
+        grid = np.arange(args.range[0], args.range[1] + args.step / 2, args.step)
+        ir, raman, weights = ensemble_spectrum(filenames, data, grid, args.fwhm, args.shape,
+                                               args.scale,
+                                               None if args.equal_weights else args.temperature,
+                                               energies, args.raman)
+    except (OSError, ValueError) as e:
+        print(e, file=stderr)
+        return 1
+
+    if args.verbose:
+        for ifile in np.argsort(-weights, kind='stable'):
+            print('{:10.6f}  {}'.format(weights[ifile], filenames[ifile]), file=stderr)
+
+    columns = [grid, ir] + ([raman] if args.raman else [])
+    if args.normalize:
+        columns[1:] = [spectrum / spectrum.max() if spectrum.max() > 0 else spectrum
+                       for spectrum in columns[1:]]
+    outfile = open(args.output, 'wt') if args.output else stdout
+    try:
+        np.savetxt(outfile, np.column_stack(columns), fmt=['%10.2f'] + ['%14.6e'] * (len(columns) - 1),
+                   header='wavenumber (cm-1)  IR' + ('  Raman' if args.raman else ''))
+    finally:
+        if args.output:
+            outfile.close()
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
+
+if __name__ == '__main__':
+    main()
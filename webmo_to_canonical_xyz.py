@@ -1,79 +1,104 @@
 #!/usr/bin/env python3
 
-import argparse, sys
+import argparse, sys, itertools
 
 import numpy as np
 
 from elements import element_label_to_number, element_number_to_symbol
+from xyz_io import parse_coordinate_block, write_xyz_frames
 
-def read_webmo_xyz(xyzfile):
-    points = []
-    titles = []
-    all_symbols = []
+def _webmo_label_to_symbol(label):
+    try:
+        label = int(label)
+    except ValueError:
+        return label
+    else:
+        return element_number_to_symbol(element_label_to_number(label))
 
+def iter_webmo_xyz(xyzfile):
+    '''Iterate over a WebMO XYZ trajectory one structure at a time, yielding
+    (coords, symbols, title) for each frame. Only one frame is held in memory
+    at once, so arbitrarily long trajectories can be streamed.
+    
+    The coordinate array yielded is a buffer that is overwritten by the next
+    frame; copy it if it must outlive the iteration.'''
+    symbols = None
+    buffer = None
     
     for line in xyzfile:
-        all_coords = []
-        symbols = []
+        if not line.strip():
+            continue
         
         if line.startswith('!'):
             # Start a new coordinate block
-            titles.append(line[1:])
+            title = line[1:]
             coord_line = xyzfile.readline()
         else:
             # Evidently there is only one structure here
-            titles.append('Converted from WebMO')
+            title = 'Converted from WebMO'
             coord_line = line
         
-        while True:    
-            if not coord_line.strip():
-                break
-                
-            (atom, x, y, z) = coord_line.split()
-
-            if not all_symbols:
-                try:
-                    atom = int(atom)
-                except ValueError:
-                    symbol = atom
-                else:
-                    symbol = element_number_to_symbol(element_label_to_number(atom))
-                symbols.append(symbol)
-            
-            coords = np.array((x,y,z), dtype=np.float64)                
-            all_coords.append(coords)
-            
+        coord_lines = []
+        while coord_line.strip():
+            coord_lines.append(coord_line)
             coord_line = xyzfile.readline()
+        
+        labels, buffer = parse_coordinate_block(''.join(coord_lines), len(coord_lines), buffer)
+        
+        if symbols is None:
+            # Resolve each distinct label only once
+            label_symbols = {label: _webmo_label_to_symbol(label) for label in set(labels)}
+            symbols = [label_symbols[label] for label in labels]
+            
+        yield (buffer, symbols, title)
 
-        if symbols:
-            all_symbols = symbols
-        points.append(np.array(all_coords))
+def read_webmo_xyz(xyzfile):
+    points = []
+    titles = []
+    all_symbols = []
+    
+    for (coords, symbols, title) in iter_webmo_xyz(xyzfile):
+        points.append(coords.copy())
+        titles.append(title)
+        all_symbols = symbols
     
     return (np.array(points), all_symbols, titles)
 
 def write_xyz(outfile, coords, symbols, titles):
-    n_atoms = coords.shape[1]
-    
-    for coord_set, title in zip(coords, titles):
-        outfile.write('{:d}\n'.format(n_atoms))
-        outfile.write('{:s}\n'.format(title.strip()))
-
-        for iatom in range(len(coord_set)):
-            outfile.write('{:>3s} {:14.6f} {:14.6f} {:14.6f}\n'.format(symbols[iatom], *list(coord_set[iatom,:])))
+    write_xyz_frames(outfile, zip(coords, itertools.repeat(symbols), titles))
     
     
-parser = argparse.ArgumentParser()
-parser.add_argument('webmo_xyz', help='WebMO XYZ trajectory')
-parser.add_argument('-o', '--output', help='Output filename (default stdout)')
-args = parser.parse_args()
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('webmo_xyz', help='WebMO XYZ trajectory ("-" for stdin)')
+    parser.add_argument('-o', '--output', help='Output filename (default stdout)')
+    return parser
+
+def run(args, stdout=None, stderr=None):
+    stdout = stdout or sys.stdout
+
+    if args.webmo_xyz == '-':
+        xyzfile = sys.stdin
+    else:
+        xyzfile = open(args.webmo_xyz, 'rt')
 
-xyzfile = open(args.webmo_xyz, 'rt')
-points, symbols, titles = read_webmo_xyz(xyzfile)
+    if args.output:
+        outfile = open(args.output, 'wt')
+    else:
+        outfile = stdout
 
+    try:
+        write_xyz_frames(outfile, iter_webmo_xyz(xyzfile))
+    finally:
+        if xyzfile is not sys.stdin:
+            xyzfile.close()
+        if outfile is not stdout:
+            outfile.close()
+    return 0
 
-if args.output:
-    outfile = open(args.output, 'wt')
-else:
-    outfile = sys.stdout
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
 
-write_xyz(outfile, points, symbols, titles)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+'''
+Reading and writing of (possibly multi-frame) XYZ files.
+
+XYZFile memory-maps an XYZ file and indexes the byte offset of every frame
+in a single pass, so that individual frames, slices of frames, or batches of
+coordinates can be read without scanning the whole file. For large files
+(index_min_size bytes or more), the index is saved next to the XYZ file (as
+FILENAME.idx) and reused as long as the XYZ file is unchanged; smaller
+files are indexed again each time they are opened. Pipes and other files
+that cannot be memory-mapped are read into memory instead.
+'''
+
+import collections, mmap, os, stat
+
+import numpy as np
+
+XYZFrame = collections.namedtuple('XYZFrame', ['coords', 'symbols', 'title'])
+
+def parse_coordinate_block(text, natoms, out=None):
+    '''Parse a block of natoms lines of the form "label x y z" into
+    (labels, coords). All coordinates are converted in one bulk operation.
+    If out is an (natoms, 3) float64 array, coordinates are stored there
+    instead of in a newly-allocated array.'''
+
+    fields = text.split()
+    if len(fields) == 4*natoms:
+        labels = fields[::4]
+        del fields[::4]
+    else:
+        # Extra (or missing) columns; only labels and x, y, z are used
+        split_lines = [line.split() for line in text.splitlines() if line.strip()]
+        if len(split_lines) != natoms or min(len(line) for line in split_lines) < 4:
+            raise ValueError('malformed coordinate block')
+        labels = [line[0] for line in split_lines]
+        fields = [field for line in split_lines for field in line[1:4]]
+
+    if out is None or out.shape != (natoms, 3) or not out.flags.c_contiguous:
+        out = np.empty((natoms, 3), np.float64)
+    # NumPy converts the strings as it fills out, without an intermediate array
+    out.ravel()[:] = fields
+    return labels, out
+
+class XYZFile:
+    '''Random access to the frames of a multi-frame XYZ file.'''
+
+    index_suffix = '.idx'
+    index_chunk_size = 64*1024*1024
+    index_min_size = 16*1024*1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+
+        file_stat = os.fstat(self._file.fileno())
+        self._stat_key = np.array([file_stat.st_size, file_stat.st_mtime_ns], np.int64)
+        self._regular = stat.S_ISREG(file_stat.st_mode)
+        if not self._regular:
+            # Pipes, /dev/stdin, <(...) etc. report a size of 0 and cannot be
+            # mapped; read them through once
+            self._mmap = self._file.read()
+        elif file_stat.st_size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b''
+
+        persist_index = self._regular and file_stat.st_size >= self.index_min_size
+        self.offsets = self._load_index() if persist_index else None
+        if self.offsets is None:
+            self.offsets = self._build_index()
+            if persist_index:
+                self._save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for iframe in range(len(self)):
+            yield self.read_frame(iframe)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.read_frame(iframe) for iframe in range(*key.indices(len(self)))]
+        return self.read_frame(key)
+
+    @property
+    def index_filename(self):
+        return self.filename + self.index_suffix
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename, 'rb') as indexfile:
+                index = np.load(indexfile)
+        except (OSError, ValueError):
+            return None
+
+        # The first two entries record the size and modification time of
+        # the XYZ file the index was built from
+        if len(index) < 3 or (index[:2] != self._stat_key).any():
+            return None
+        return index[2:]
+
+    def _save_index(self):
+        try:
+            with open(self.index_filename, 'wb') as indexfile:
+                np.save(indexfile, np.concatenate([self._stat_key, self.offsets]))
+        except OSError:
+            # Index is only a cache (e.g. the directory may be read-only)
+            pass
+
+    def _build_index(self):
+        '''Find the byte offset of every frame, in one pass over the file.
+        Newlines are located a chunk at a time with NumPy; only frame headers
+        are examined in Python.'''
+
+        data = self._mmap
+        size = len(data)
+        offsets = []
+
+        header_line = 0      # line number of the next frame header
+        header_start = 0     # byte offset of that line (None if not yet known)
+        first_line = 0       # line number ended by the first newline of the chunk
+        done = False
+
+        for chunk_start in range(0, size, self.index_chunk_size):
+            chunk_len = min(self.index_chunk_size, size - chunk_start)
+            newlines = np.flatnonzero(np.frombuffer(data, np.uint8, count=chunk_len,
+                                                    offset=chunk_start) == ord('\n'))
+            newlines += chunk_start
+            if chunk_start + chunk_len == size and data[size-1:size] != b'\n':
+                # Treat end of file as the end of an unterminated last line
+                newlines = np.append(newlines, size)
+
+            while not done:
+                if header_start is None:
+                    inewline = header_line - 1 - first_line
+                    if inewline >= len(newlines):
+                        break
+                    header_start = int(newlines[inewline]) + 1
+
+                inewline = header_line - first_line
+                if inewline >= len(newlines):
+                    break
+                header = bytes(data[header_start:newlines[inewline]]).strip()
+                if not header:
+                    # Trailing blank lines
+                    done = True
+                    break
+
+                try:
+                    natoms = int(header)
+                except ValueError:
+                    raise ValueError('{}: invalid atom count {!r} at byte {:d}'
+                                     .format(self.filename, header.decode(), header_start))
+                offsets.append(header_start)
+                header_line += natoms + 2
+                header_start = None
+
+            first_line += len(newlines)
+            if done:
+                break
+
+        if header_start is None:
+            # The line following the last frame was never reached
+            raise ValueError('{}: last frame is truncated'.format(self.filename))
+        # The last frame ends where the next header would start
+        offsets.append(header_start)
+
+        return np.array(offsets, np.int64)
+
+    def _frame_text(self, iframe):
+        if iframe < 0:
+            iframe += len(self)
+        if not 0 <= iframe < len(self):
+            raise IndexError('frame {:d} out of range ({:d} frames)'.format(iframe, len(self)))
+
+        text = bytes(self._mmap[self.offsets[iframe]:self.offsets[iframe+1]]).decode()
+        (count, title, block) = text.split('\n', 2)
+        return int(count), title, block
+
+    def read_frame(self, iframe, out=None):
+        '''Read frame iframe, returning an XYZFrame.'''
+        natoms, title, block = self._frame_text(iframe)
+        symbols, coords = parse_coordinate_block(block, natoms, out)
+        return XYZFrame(coords, symbols, title.strip())
+
+    def read_coords(self, frames=None):
+        '''Read the coordinates of several frames (default: all) into a
+        (frames, atoms, 3) array. frames may be a slice or a sequence of
+        frame indices.'''
+
+        if frames is None:
+            frames = range(len(self))
+        elif isinstance(frames, slice):
+            frames = range(*frames.indices(len(self)))
+
+        coords = None
+        for ibatch, iframe in enumerate(frames):
+            natoms, title, block = self._frame_text(iframe)
+            if coords is None:
+                coords = np.empty((len(frames), natoms, 3), np.float64)
+            elif natoms != coords.shape[1]:
+                raise ValueError('{}: frames do not have the same number of atoms'
+                                 .format(self.filename))
+            parse_coordinate_block(block, natoms, coords[ibatch])
+
+        if coords is None:
+            coords = np.empty((0, 0, 3), np.float64)
+        return coords
+
+def read_xyz_frame(filename, iframe=0):
+    '''Read one frame of an XYZ file'''
+    with XYZFile(filename) as xyzfile:
+        return xyzfile.read_frame(iframe)
+
+def _xyz_frame_template(symbols):
+    # Symbols are baked into the template so that each frame is formatted
+    # with a single str.format() call and written with a single write()
+    return ''.join('{:>3s}'.format(symbol) + ' {:14.6f} {:14.6f} {:14.6f}\n'
+                   for symbol in symbols)
+
+def write_xyz_frames(outfile, frames):
+    '''Write (coords, symbols, title) frames to outfile as they are produced.
+    All frames are assumed to have the same atoms as the first; a frame with
+    a different number of atoms raises ValueError.'''
+    template = None
+
+    for (coords, symbols, title) in frames:
+        if template is None:
+            template = _xyz_frame_template(symbols)
+            natoms = len(symbols)
+        if len(coords) != natoms or len(symbols) != natoms:
+            # str.format() would silently drop the extra coordinates
+            raise ValueError('frame {!r} has {:d} atoms; expected {:d}'
+                             .format(title.strip(), len(coords), natoms))
+        outfile.write('{:d}\n{:s}\n'.format(len(coords), title.strip()))
+        outfile.write(template.format(*coords.ravel()))
+
+def write_xyz_frame(outfile, coords, symbols, title):
+    write_xyz_frames(outfile, [(coords, symbols, title)])
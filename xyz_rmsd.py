@@ -1,35 +1,70 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument('xyz1')
-parser.add_argument('xyz2')
-parser.add_argument('--noalign', action='store_true',
-                    help='Do not align structures prior to calculating RMSD')
-parser.add_argument('--nocenter', action='store_true',
-                    help='Do not center structures prior to calculating RMSD. Implies --noalign.')
-args = parser.parse_args()
-
-xyz1 = np.loadtxt(args.xyz1, skiprows=2, usecols=[1,2,3])
-xyz2 = np.loadtxt(args.xyz2, skiprows=2, usecols=[1,2,3])
-
-if args.nocenter:
-    args.noalign = True
-else:
-    xyz1 -= xyz1.mean(axis=0)
-    xyz2 -= xyz2.mean(axis=0)
-    
-if args.noalign:
-    rmsd = ((xyz2 - xyz1)**2).sum(axis=1).mean(axis=0) ** 0.5
-else:
-    import pyximport
-    pyximport.install(inplace=True, language_level=3,
-                      setup_args={"include_dirs":np.get_include()})
-    import qcprot 
-    
-    rmsd = qcprot.CalcRMSDRotationalMatrix(xyz1, xyz2, len(xyz1), None, None)
-
-print('{}'.format(rmsd))
+import argparse, sys
 
+from xyz_io import read_xyz_frame
+
+_qcprot = None
+
+def load_qcprot():
+    '''Import (compiling if necessary) the QCP kernel'''
+    global _qcprot
+    if _qcprot is None:
+        import pyximport
+        pyximport.install(inplace=True, language_level=3,
+                          setup_args={"include_dirs":np.get_include()})
+        import qcprot
+        _qcprot = qcprot
+    return _qcprot
+
+def load_structure(filename, iframe=0):
+    return read_xyz_frame(filename, iframe).coords
+
+def calc_rmsd(xyz1, xyz2, center=True, align=True):
+    '''RMSD between two (N, 3) coordinate arrays. Alignment requires centering.
+    The input arrays are not modified.'''
+    if center:
+        xyz1 = xyz1 - xyz1.mean(axis=0)
+        xyz2 = xyz2 - xyz2.mean(axis=0)
+    else:
+        align = False
+
+    if not align:
+        return ((xyz2 - xyz1)**2).sum(axis=1).mean(axis=0) ** 0.5
+    else:
+        qcprot = load_qcprot()
+        return qcprot.CalcRMSDRotationalMatrix(xyz1, xyz2, len(xyz1), None, None)
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('xyz1')
+    parser.add_argument('xyz2')
+    parser.add_argument('--noalign', action='store_true',
+                        help='Do not align structures prior to calculating RMSD')
+    parser.add_argument('--nocenter', action='store_true',
+                        help='Do not center structures prior to calculating RMSD. Implies --noalign.')
+    parser.add_argument('--frame1', type=int, default=0,
+                        help='Frame of XYZ1 to use; negative values count from the end '
+                            +'(default: %(default)s)')
+    parser.add_argument('--frame2', type=int, default=0,
+                        help='Frame of XYZ2 to use; negative values count from the end '
+                            +'(default: %(default)s)')
+    return parser
+
+def run(args, stdout=None, stderr=None, load_structure=load_structure):
+    stdout = stdout or sys.stdout
+
+    xyz1 = load_structure(args.xyz1, args.frame1)
+    xyz2 = load_structure(args.xyz2, args.frame2)
+
+    rmsd = calc_rmsd(xyz1, xyz2, center=not args.nocenter, align=not args.noalign)
+    print('{}'.format(rmsd), file=stdout)
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.exit(run(args))
+
+if __name__ == '__main__':
+    main()